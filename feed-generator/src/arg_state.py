@@ -20,6 +20,9 @@ class ArgState(DataClassJsonMixin):
     something changed, we can just print the key that is different)
 
     (Also note: The mixin is for my LSP to remain happy)
+
+    (Also also note: *_thumbnail are blob references, `blobs/<sha256>.jpg`,
+    published next to cache.json. Older states have data URLs instead)
     """
     numbers_1_video_info: VideoInformation
     numbers_1_video_hash: str
@@ -0,0 +1,163 @@
+"""
+Content-addressed store of downloaded assets (thumbnails).
+
+Every blob is a file named after the sha256 of its content, so storing
+the same content twice is free, and a reference to it never goes stale.
+ArgState keeps these references (`blobs/<sha256>.jpg`) instead of
+inline base64 copies; the blobs are published next to cache.json, and
+the web UI loads them from there when it needs them.
+
+Within a run, every URL is downloaded at most once: the store remembers
+which digest each URL had. Across runs, downloads are conditional (see
+http_cache.py): when a URL did not change and the previous state already
+references its blob, that blob is published already, and the reference
+is reused without downloading or writing anything.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+from typing import Callable, Iterable, Optional
+
+BLOB_DIRECTORY = 'blobs'
+# Content types of the blobs we keep, by their magic bytes. Browsers
+# need an extension they recognize to display a blob
+EXTENSIONS = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'RIFF', 'webp'),
+    (b'GIF8', 'gif'),
+)
+
+
+def blob_extension(data: bytes) -> str:
+    """
+    Guesses the extension of a blob from its first bytes.
+
+    Args:
+        data (bytes): The blob
+
+    Returns:
+        str: The extension, `bin` if unknown
+    """
+    for magic, extension in EXTENSIONS:
+        if data.startswith(magic):
+            return extension
+    return 'bin'
+
+
+def blob_reference(digest: str, extension: str) -> str:
+    """
+    Gets the reference of a blob, i.e. its path relative to the
+    published files.
+
+    Args:
+        digest (str): The sha256 of the blob
+        extension (str): Its extension
+
+    Returns:
+        str: The reference
+    """
+    return f'{BLOB_DIRECTORY}/{digest}.{extension}'
+
+
+def data_url_reference(data_url: str) -> str:
+    """
+    Gets the reference the content of a `data:` URL would have, e.g. to
+    compare states from before thumbnails became blobs.
+
+    Args:
+        data_url (str): The URL, `data:<type>;base64,<content>`
+
+    Returns:
+        str: The reference
+    """
+    data = base64.b64decode(data_url.split(',', 1)[1])
+    return blob_reference(hashlib.sha256(data).hexdigest(),
+                          blob_extension(data))
+
+
+class BlobStore:
+    """
+    A directory of blobs, plus the URL -> reference memo of this run.
+    Safe to use from several threads.
+    """
+    def __init__(self, directory: str,
+                 download: Callable[[str, bool], tuple[Optional[bytes],
+                                                       str]],
+                 published: Iterable[str] = ()) -> None:
+        """
+        Creates the directory, if needed.
+
+        Args:
+            directory (str): The directory
+            download (Callable[[str, bool], tuple[Optional[bytes], str]]):
+                Downloads a URL like utils.conditional_get(url,
+                keep_body): its content (None if it did not change and
+                keep_body is False) and its sha256
+            published (Iterable[str]): References that are published
+                already, e.g. the ones of the previous state
+        """
+        self.directory = directory
+        self.download = download
+        self.published = {
+            os.path.basename(reference).split('.', 1)[0]: reference
+            for reference in published
+            if reference.startswith(f'{BLOB_DIRECTORY}/')}
+        self.lock = threading.Lock()
+        self.url_locks: dict[str, threading.Lock] = {}
+        self.memo: dict[str, tuple[str, str]] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data: bytes) -> tuple[str, str]:
+        """
+        Stores a blob, unless it is there already.
+
+        Args:
+            data (bytes): The blob
+
+        Returns:
+            tuple[str, str]: Its sha256 and its reference
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        extension = blob_extension(data)
+        path = os.path.join(self.directory, f'{digest}.{extension}')
+        if not os.path.exists(path):
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            logging.info('Stored blob %s', path)
+        return digest, blob_reference(digest, extension)
+
+    def fetch(self, url: str) -> tuple[str, str]:
+        """
+        Downloads a URL into the store, once per run.
+
+        Args:
+            url (str): The URL
+
+        Returns:
+            tuple[str, str]: The sha256 of its content and its reference
+        """
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        # Concurrent fetches of the same URL wait for the first one
+        with url_lock:
+            if url not in self.memo:
+                self.memo[url] = self.__fetch(url)
+            return self.memo[url]
+
+    def __fetch(self, url: str) -> tuple[str, str]:
+        data, digest = self.download(url, False)
+        if data is None:
+            if digest in self.published:
+                logging.info('%s did not change, its blob is published',
+                             url)
+                return digest, self.published[digest]
+            # Not modified, but its blob is not published (yet)
+            data, digest = self.download(url, True)
+            assert data is not None
+        return self.put(data)
@@ -0,0 +1,117 @@
+"""
+Runs independent fetches concurrently, politely.
+
+Fetches run on a bounded thread pool. Every fetch is tagged with the URL
+it is about, and at most a few fetches per host run at the same time,
+so the pool never hammers one site (YouTube, mostly) even when it has
+free threads.
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+from urllib.parse import urlparse
+
+
+def host_of(url: str) -> str:
+    """
+    Gets the host a URL counts against, i.e. its last two labels, so
+    that `www.youtube.com` and `youtube.com` share their limit.
+
+    Args:
+        url (str): The URL
+
+    Returns:
+        str: The host
+    """
+    hostname = urlparse(url).hostname or url
+    return '.'.join(hostname.split('.')[-2:])
+
+
+class Collector:
+    """
+    A thread pool with a concurrency limit per host. Fetches over their
+    host's limit wait in a queue per host, without holding a thread, so
+    fetches to other hosts go ahead meanwhile.
+
+    Usage:
+
+        with Collector(8, {'youtube.com': 2}, 4) as collector:
+            future = collector.submit(url, fn, *args)
+            ...
+            value = future.result()
+    """
+    def __init__(self, max_workers: int, host_limits: dict[str, int],
+                 default_host_limit: int) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='collector')
+        self.host_limits = host_limits
+        self.default_host_limit = default_host_limit
+        self.lock = threading.Lock()
+        self.running: dict[str, int] = {}
+        self.queued: dict[str, deque] = {}
+        self.futures: list[Future] = []
+
+    def __enter__(self) -> 'Collector':
+        return self
+
+    def __exit__(self, exc_type: Optional[type], *_: Any) -> None:
+        if exc_type is not None:
+            # A fetch failed for good: do not start the ones still queued
+            with self.lock:
+                for queue in self.queued.values():
+                    for _fn, _args, future in queue:
+                        future.cancel()
+                        future.set_running_or_notify_cancel()
+                    queue.clear()
+        # Running fetches may still start queued ones, so wait for every
+        # fetch before shutting the pool down
+        wait(self.futures)
+        self.executor.shutdown(wait=True)
+
+    def __start_queued(self, host: str) -> None:
+        with self.lock:
+            limit = self.host_limits.get(host, self.default_host_limit)
+            queue = self.queued[host]
+            while queue and self.running[host] < limit:
+                fn, args, future = queue.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running[host] += 1
+                self.executor.submit(self.__run, host, fn, args, future)
+
+    def __run(self, host: str, fn: Callable[..., Any], args: tuple,
+              future: Future) -> None:
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:  # pylint: disable=broad-except
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running[host] -= 1
+            self.__start_queued(host)
+
+    def submit(self, url: str, fn: Callable[..., Any],
+               *args: Any) -> Future:
+        """
+        Schedules a fetch.
+
+        Args:
+            url (str): The URL the fetch is about, to limit its host
+            fn (Callable[..., Any]): The fetch
+            *args (Any): Its arguments
+
+        Returns:
+            Future: The result of the fetch
+        """
+        host = host_of(url)
+        future: Future = Future()
+        with self.lock:
+            self.running.setdefault(host, 0)
+            self.queued.setdefault(host, deque()).append((fn, args, future))
+            self.futures.append(future)
+        logging.debug('Queued a fetch of %s (%s)', url, host)
+        self.__start_queued(host)
+        return future
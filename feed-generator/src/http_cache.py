@@ -0,0 +1,143 @@
+"""
+Persistent cache of HTTP validators.
+
+For every URL downloaded before, the cache keeps its ETag and/or
+Last-Modified, and the sha256 of its content. The next download sends
+them back (If-None-Match/If-Modified-Since), and when the server answers
+304 Not Modified, the stored hash is reused instead of downloading and
+hashing the content again. The content itself is only kept for the
+URLs whose callers need it (feeds, published Twitch results), not for
+images, which are only ever hashed.
+
+The file is restored and saved between runs, like cache.json. Only the
+URLs requested during the run are saved, so URLs that are no longer
+downloaded (or no longer conditionally) do not linger.
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+import requests
+
+HTTP_CACHE_VERSION = 1
+
+
+class HttpCache:
+    """
+    The validators, hashes and (some) contents of the URLs downloaded
+    before. Safe to use from several threads.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self.requested: set[str] = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        try:
+            with open(path, encoding='utf-8') as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.warning('Could not read HTTP cache %s, starting over',
+                            path, exc_info=True)
+            return
+
+        if cache.get('version') != HTTP_CACHE_VERSION:
+            logging.info('HTTP cache %s has an unknown version, starting '
+                         'over', path)
+            return
+        self.entries = cache.get('entries', {})
+
+    def validators(self, url: str, need_body: bool) -> dict[str, str]:
+        """
+        Gets the conditional request headers of a URL.
+
+        Args:
+            url (str): The URL
+            need_body (bool): Whether the caller needs the content. If
+                              so, and it was not kept, the URL is
+                              downloaded unconditionally
+
+        Returns:
+            dict[str, str]: The headers, empty if the URL is unknown
+        """
+        with self.lock:
+            self.requested.add(url)
+            entry = self.entries.get(url)
+        if entry is None or (need_body and 'body' not in entry):
+            return {}
+        headers = {}
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def not_modified(self, url: str) -> tuple[Optional[bytes], str]:
+        """
+        Records a 304 Not Modified.
+
+        Args:
+            url (str): The URL
+
+        Returns:
+            tuple[Optional[bytes], str]: The kept content, if any, and
+                                         the sha256 of the content
+        """
+        with self.lock:
+            entry = self.entries[url]
+            self.hits += 1
+            self.bytes_saved += entry['length']
+        body = base64.b64decode(entry['body']) if 'body' in entry else None
+        return body, entry['sha256']
+
+    def modified(self, url: str, response: requests.Response, digest: str,
+                 keep_body: bool) -> None:
+        """
+        Records a full response.
+
+        Args:
+            url (str): The URL
+            response (requests.Response): The response
+            digest (str): The sha256 of the content
+            keep_body (bool): Whether to keep the content
+        """
+        entry = {'sha256': digest, 'length': len(response.content)}
+        if 'ETag' in response.headers:
+            entry['etag'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            entry['last_modified'] = response.headers['Last-Modified']
+        if keep_body:
+            entry['body'] = base64.b64encode(response.content).decode('ascii')
+
+        with self.lock:
+            self.misses += 1
+            if 'etag' in entry or 'last_modified' in entry:
+                self.entries[url] = entry
+            else:
+                # Nothing to validate with next time
+                self.entries.pop(url, None)
+
+    def save(self) -> None:
+        """
+        Atomically rewrites the cache file with the URLs requested
+        during the run, and logs how useful it was.
+        """
+        with self.lock:
+            entries = {url: entry for url, entry in self.entries.items()
+                       if url in self.requested}
+            cache = {'version': HTTP_CACHE_VERSION, 'entries': entries}
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+            os.replace(temp_path, self.path)
+            logging.info('HTTP cache: %d hits, %d misses, %d bytes saved, '
+                         '%d stale URLs dropped', self.hits, self.misses,
+                         self.bytes_saved, len(self.entries) - len(entries))
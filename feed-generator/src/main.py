@@ -14,6 +14,8 @@ from uuid import uuid4
 from feedgen.feed import FeedGenerator
 
 from arg_state import ArgState
+from blob_store import data_url_reference
+from collector import Collector
 from metadata.feeds import FeedGetter
 from metadata.soundcloud_metadata import (SoundCloudUserGetter,
                                           SoundCloudUserInformation)
@@ -21,6 +23,7 @@ from metadata.youtube_metadata import VideoInformation, VideoInformationGetter
 from metadata.ytc_metadata import ChannelInformation, ChannelInformationGetter
 from sources.twitch_source import TwitchSource
 from sources.youtube_source import YoutubeSource
+from utils import use_blob_store, use_http_cache
 
 logging.basicConfig(
     level=logging.INFO,
@@ -29,6 +32,11 @@ logging.basicConfig(
 RETRY_NO = 5
 RETRY_INTERVAL = 30
 DELAY_INTERVAL = 5
+# Fetches run on this many threads, but at most HOST_LIMITS (or
+# DEFAULT_HOST_LIMIT) of them per host at once
+MAX_WORKERS = 8
+HOST_LIMITS = {'youtube.com': 2}
+DEFAULT_HOST_LIMIT = 4
 
 NUMBERS_1_URL = "https://www.youtube.com/watch?v=wc-QCoMm4J8"
 NUMBERS_2_URL = "https://www.youtube.com/watch?v=giJI-TDbO5k"
@@ -46,6 +54,21 @@ YOUTUBE_FEED_URL = \
 SOUNDCLOUD_FEED_URL = "https://feeds.soundcloud.com/users/soundcloud:users:1258077262/sounds.rss"
 
 YOUTUBE_CHANNEL_URL = "https://www.youtube.com/@_neurosama"
+HTTP_CACHE_FILE = 'http_cache.json'
+TWITCH_RESULTS_URL = "https://raw.githubusercontent.com/neuro-arg/"
+
+# In the order of ArgState
+VIDEO_URLS = [
+    NUMBERS_1_URL,
+    STUDY_URL,
+    NUMBERS_2_URL,
+    PSV_URL,
+    FILTERED_URL,
+    HELLO_WORLD_URL,
+    MEANING_OF_LIFE_URL,
+    CANDLES_URL,
+    NUMBERS_3_URL,
+]
 
 
 def get_video_info_and_content(url) -> tuple[VideoInformation, str, str]:
@@ -81,6 +104,18 @@ def while_none_retry_max(fn: Callable[[], Any | None]) -> Any:
     raise RuntimeError("Operation failed after all retires")
 
 
+http_cache = use_http_cache(HTTP_CACHE_FILE)
+
+# The blobs the previous state references are published already, so the
+# thumbnails that did not change are not downloaded again
+published_blobs: list[str] = []
+if os.path.exists('cache.json'):
+    with open('cache.json', 'r', encoding='ascii') as f:
+        published_blobs = [value for key, value in json.load(f).items()
+                           if key.endswith('_thumbnail')
+                           and isinstance(value, str)]
+use_blob_store(published_blobs)
+
 youtube_feed_getter = FeedGetter(
     YOUTUBE_FEED_URL,
     ['{http://search.yahoo.com/mrss/}community'])
@@ -89,23 +124,33 @@ soundcloud_feed_getter = FeedGetter(
     SOUNDCLOUD_FEED_URL, []
 )
 
-current_state = ArgState(
-    *get_video_info_and_content(NUMBERS_1_URL),
-    *get_video_info_and_content(STUDY_URL),
-    *get_video_info_and_content(NUMBERS_2_URL),
-    *get_video_info_and_content(PSV_URL),
-    *get_video_info_and_content(FILTERED_URL),
-    *get_video_info_and_content(HELLO_WORLD_URL),
-    *get_video_info_and_content(MEANING_OF_LIFE_URL),
-    *get_video_info_and_content(CANDLES_URL),
-    *get_video_info_and_content(NUMBERS_3_URL),
-    while_none_retry_max(SoundCloudUserGetter(SOUNDCLOUD_URL).get),
-    while_none_retry_max(youtube_feed_getter.get),
-    while_none_retry_max(soundcloud_feed_getter.get),
-    while_none_retry_max(TwitchSource('neuro').get),
-    while_none_retry_max(TwitchSource('evil').get),
-    while_none_retry_max(ChannelInformationGetter(YOUTUBE_CHANNEL_URL).get),
-)
+# Every fetch is independent: run them all at once, then assemble the
+# state in field order
+with Collector(MAX_WORKERS, HOST_LIMITS, DEFAULT_HOST_LIMIT) as collector:
+    video_futures = [
+        collector.submit(url, get_video_info_and_content, url)
+        for url in VIDEO_URLS]
+    other_futures = [
+        collector.submit(SOUNDCLOUD_URL, while_none_retry_max,
+                         SoundCloudUserGetter(SOUNDCLOUD_URL).get),
+        collector.submit(YOUTUBE_FEED_URL, while_none_retry_max,
+                         youtube_feed_getter.get),
+        collector.submit(SOUNDCLOUD_FEED_URL, while_none_retry_max,
+                         soundcloud_feed_getter.get),
+        collector.submit(TWITCH_RESULTS_URL, while_none_retry_max,
+                         TwitchSource('neuro').get),
+        collector.submit(TWITCH_RESULTS_URL, while_none_retry_max,
+                         TwitchSource('evil').get),
+        collector.submit(YOUTUBE_CHANNEL_URL, while_none_retry_max,
+                         ChannelInformationGetter(YOUTUBE_CHANNEL_URL).get),
+    ]
+
+    current_state = ArgState(
+        *[value for future in video_futures for value in future.result()],
+        *[future.result() for future in other_futures],
+    )
+
+http_cache.save()
 
 cached_state: Optional[ArgState] = None
 
@@ -119,6 +164,11 @@ if not os.path.exists('cache.json'):
 else:
     with open('cache.json', 'r', encoding='ascii') as f:
         cached_state = ArgState.from_json(f.read(), infer_missing=True)
+        # Thumbnails used to be inline data URLs: compare by blob instead
+        for key, value in vars(cached_state).items():
+            if key.endswith('_thumbnail') and isinstance(value, str) \
+                    and value.startswith('data:'):
+                setattr(cached_state, key, data_url_reference(value))
         for (u, v) in zip(current_state.to_dict().items(),
                           cached_state.to_dict().items()):
             # compare string-wise to bypass any reference comparison
@@ -13,6 +13,8 @@ from typing import Optional
 
 import requests
 
+from utils import conditional_get
+
 
 class FeedGetter:
     """
@@ -26,10 +28,12 @@ class FeedGetter:
 
     @staticmethod
     def __download_guard(url: str) -> str:
-        response = requests.get(url, timeout=60)
-        if response.status_code != 200:
-            raise RuntimeError(f"Could not feed from {url}")
-        return response.text
+        try:
+            content, _ = conditional_get(url, keep_body=True)
+        except requests.HTTPError as e:
+            raise RuntimeError(f"Could not feed from {url}") from e
+        assert content is not None
+        return content.decode('utf-8')
 
     def __interpret_and_remove_tags(self, feed: str) -> str:
         tree = ET.fromstring(feed)
@@ -9,10 +9,9 @@ import logging
 from dataclasses import dataclass
 from typing import Optional
 
-import requests
 from bs4 import BeautifulSoup
 from dataclasses_json import dataclass_json
-from utils import download_encode_and_hash
+from utils import download_encode_and_hash, http_get
 
 
 @dataclass_json
@@ -46,7 +45,7 @@ class SoundCloudUserGetter:
 
         try:
             logging.info("Getting user information for %s", self.url)
-            response = requests.get(self.url, timeout=60)
+            response = http_get(self.url)
             soup = BeautifulSoup(response.content, "html.parser")
 
             matches = [
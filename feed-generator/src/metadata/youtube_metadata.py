@@ -1,19 +1,18 @@
 """
 Pulls metadata from YouTube.
 
-All images will be encoded into base64
+Thumbnails are kept in the blob store, and referenced by their blob
 """
 
 import logging
 import os
-import base64
 from dataclasses import dataclass
 from typing import Optional
 from uuid import uuid4
 
 import yt_dlp
 from dataclasses_json import dataclass_json
-from utils import download_encode_and_hash, check_proxy_variables, download
+from utils import check_proxy_variables, fetch_blob
 
 
 @dataclass_json
@@ -33,7 +32,7 @@ class VideoInformation:
 @dataclass
 class VideoInformationWithThumbnail:
     """
-    VideoInformation but with thumbnail data
+    VideoInformation but with a reference to the thumbnail blob
     """
 
     info: VideoInformation
@@ -59,11 +58,6 @@ class VideoInformationGetter:
         os.remove(filename)
         return contents
 
-    @staticmethod
-    def __to_base64_url(data: bytes) -> str:
-        data_as_base64 = base64.b64encode(data).decode()
-        return f"data:image/jpeg;base64,{data_as_base64}"
-
     def __get_subtitles(self) -> str:
         """
         Gets the subtitles via youtube_dl. Because of how youtube_dl
@@ -108,17 +102,19 @@ class VideoInformationGetter:
             logging.info("Getting video information for %s", self.url)
             with yt_dlp.YoutubeDL(self.options) as ydl:
                 info = ydl.sanitize_info(ydl.extract_info(self.url, download=False))
+                # One download gives both the hash and the blob
+                thumbnail_hash, thumbnail_blob = fetch_blob(info["thumbnail"])
 
                 self.solution = VideoInformationWithThumbnail(
                     VideoInformation(
                         info["title"],
                         info["duration"],
                         info["description"],
-                        download_encode_and_hash(info["thumbnail"]),
+                        thumbnail_hash,
                         info["tags"],
                         self.__get_subtitles(),
                     ),
-                    self.__to_base64_url(download(info["thumbnail"])),
+                    thumbnail_blob,
                 )
             return self.solution
         except:  # pylint: disable=bare-except # noqa: E722
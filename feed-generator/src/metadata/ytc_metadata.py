@@ -9,10 +9,9 @@ import time
 from dataclasses import dataclass
 from typing import Any, Callable, Optional
 
-import requests
 from bs4 import BeautifulSoup
 from dataclasses_json import dataclass_json
-from utils import download_encode_and_hash
+from utils import download_encode_and_hash, http_get
 
 
 @dataclass_json
@@ -74,7 +73,7 @@ class ChannelInformationGetter:
         )
 
     def _get_and_parse(self) -> Optional[ChannelInformation]:
-        response = requests.get(self.url, timeout=5)
+        response = http_get(self.url)
         parsed = BeautifulSoup(response.text, 'html.parser')
         scripts = parsed.find_all('script')
 
@@ -7,38 +7,69 @@ each image and a particular square.
 
 After this script is done, it will plot the SSIM scores for each
 video.
+
+The score of every (clip, square) pair is cached in ANALYZE_CACHE
+(analyze_cache.json by default, empty to disable), so a rerun only
+downloads the clips that were added, only scores the squares that were
+added or changed, and rebuilds results.npz from the cache.
+
+If ANALYZE_STORE is set to a directory, the score of every square in
+every frame is also kept there (see score_store.py), for calibration
+scripts. Frames are then decoded at ANALYZE_FPS (30 by default) so that
+every frame has a timestamp.
+
+Every line of the training clips list is a URL, optionally followed by
+the window to analyze (`url start end`, in seconds or [HH:]MM:SS). Only
+the window is downloaded, with yt-dlp, and downloaded clips are kept in
+ANALYZE_CLIP_CACHE (clip_cache by default, empty to stream whole clips
+without keeping them).
 """
 
 import os
-import re
+import subprocess
 import time
 import logging
-from collections import namedtuple
-from io import BytesIO
 from multiprocessing import Pool
 from tempfile import TemporaryDirectory
 
 import numpy as np
 from PIL import Image
 
+from batched_ssim import FrameScorer
+from instrumentation import NULL_TIMERS, StageTimers
+from reference_bank import load_bank
+from score_cache import ScoreCache, settings_fingerprint, square_keys
+from score_store import DEFAULT_DTYPE, ScoreStore
 from utils import (calculate_ssim, create_process_for_720p_video_for_youtube,
-                   nparray_crop_frame, nparray_segment_into_squares,
-                   ppm_header_parser, calculate_rgb_diff,
-                   WHOSE_STREAM_SQUARE_NUMBER)
+                   create_process_for_ffmpeg_video, download_youtube_clip,
+                   parse_training_clip, RawFrameReader, calculate_rgb_diff,
+                   SourceImageTuple, ROI_LAYOUT)
 
 logging.basicConfig(level=logging.DEBUG, filename='analyze.log')
 
-# Tuples
-SourceImageTuple = namedtuple('SourceImageTuple',
-                              ['array', 'square_number'])
-
 # Constants
-IMAGES: list[SourceImageTuple] = []
-IMAGES_FILENAME_PATTERN = r'square_(\d+)_(\d+).png'
 DEPTH = 3  # hardcoded for speed
 SQUARE_SIZE = 20
 DETECTOR_THRESHOLD = 0.9
 GRACE_DETECTOR_PERIOD = 15  # number of frames off detection before quitting
+# Squares whose pixels moved by at most this much since they were last
+# scored keep their last score. -1 rescores every square of every frame
+DELTA_TOLERANCE = int(os.getenv('ANALYZE_DELTA_TOLERANCE', '0'))
+# Set to a path to time every stage of every frame and write a summary there
+TIMINGS_FILE = os.getenv('ANALYZE_TIMINGS')
+CACHE_FILE = os.getenv('ANALYZE_CACHE', 'analyze_cache.json')
+STORE_DIRECTORY = os.getenv('ANALYZE_STORE')
+STORE_DTYPE = os.getenv('ANALYZE_STORE_DTYPE', DEFAULT_DTYPE)
+# Frame rate to decode at. Empty keeps the rate of the video, except with
+# a store: its timestamps need a fixed rate, 30 unless set
+FPS = int(os.getenv('ANALYZE_FPS') or (30 if STORE_DIRECTORY else 0)) \
+    or None
+if FPS is not None and FPS < 0:
+    raise ValueError(f'ANALYZE_FPS must be positive, not {FPS}')
+if STORE_DIRECTORY and FPS is None:
+    raise ValueError('ANALYZE_STORE needs a fixed frame rate, set '
+                     'ANALYZE_FPS to a positive number')
+CLIP_CACHE_DIRECTORY = os.getenv('ANALYZE_CLIP_CACHE', 'clip_cache')
 TRAINING_CLIPS_LIST = input("Training clips list: ")
 SRC_DIRECTORY = input('Source Directory: ')
 DETECTION_SQUARE = input('Path to detection square: ')
@@ -54,18 +85,29 @@ if not os.path.exists(TRAINING_CLIPS_LIST):
     raise FileNotFoundError(f"The file {TRAINING_CLIPS_LIST} does not exist.")
 
 with open(TRAINING_CLIPS_LIST, encoding='utf8') as file:
-    YOUTUBE_VIDEOS = file.read().splitlines()
-
-for file in sorted(os.listdir(SRC_DIRECTORY)):
-    image = Image.open(os.path.join(SRC_DIRECTORY, file))
-    matches = re.match(IMAGES_FILENAME_PATTERN, file)
-
-    if not matches:
-        print(f'The file {file} does not match the pattern. Skipping.')
-        continue
-
-    square_idx, sequence = matches.groups()
-    IMAGES.append(SourceImageTuple(np.array(image), int(square_idx)))
+    YOUTUBE_VIDEOS = [line.strip() for line in file.read().splitlines()
+                      if line.strip()]
+# Fail before downloading anything if a line is malformed
+for line in YOUTUBE_VIDEOS:
+    parse_training_clip(line)
+
+BANK = load_bank(SRC_DIRECTORY)
+SCORER = FrameScorer([BANK], ROI_LAYOUT, SQUARE_SIZE,
+                     delta_tolerance=(DELTA_TOLERANCE if DELTA_TOLERANCE >= 0
+                                      else None))
+SQUARE_KEYS = square_keys(BANK)
+with open(DETECTION_SQUARE, 'rb') as file:
+    FINGERPRINT = settings_fingerprint(
+        detection_square=file.read(), square_size=SQUARE_SIZE,
+        detector_threshold=DETECTOR_THRESHOLD,
+        grace_detector_period=GRACE_DETECTOR_PERIOD,
+        delta_tolerance=DELTA_TOLERANCE, **({'fps': FPS} if FPS else {}))
+CACHE = ScoreCache(os.path.abspath(CACHE_FILE), FINGERPRINT) \
+    if CACHE_FILE else None
+STORE = ScoreStore(os.path.abspath(STORE_DIRECTORY)) \
+    if STORE_DIRECTORY else None
+CLIP_CACHE = os.path.abspath(CLIP_CACHE_DIRECTORY) \
+    if CLIP_CACHE_DIRECTORY else None
 
 # Functions
 def process_squares_with_target_image(
@@ -90,8 +132,27 @@ def process_squares_with_target_images(params: tuple[np.ndarray, list[SourceImag
     return list(process_squares_with_target_image((arr, tuple)) for tuple in tuples)
 
 
-def do_one_video(link: str) -> list[float]:
+def do_one_video(params: tuple[str, np.ndarray]
+                 ) -> tuple[str, np.ndarray, int, dict[str, list]]:
+    """
+    Scores the squares of a video. This function is designed to be run
+    with multiprocessing.
+
+    Args:
+        params (tuple[str, np.ndarray]): The line of the video in the
+                                         clips list and a boolean mask
+                                         of the squares of BANK to score
+
+    Returns:
+        tuple[str, np.ndarray, int, dict[str, list]]: The link, the best
+            score of every square (-1 for the ones not scored), the
+            number of frames scored and the raw stage timings
+    """
+    link, active = params
+    clip = parse_training_clip(link)
     ds = np.array(Image.open(DETECTION_SQUARE))
+    timers = StageTimers() if TIMINGS_FILE else NULL_TIMERS
+    SCORER.timers = timers
     curr_dir = os.getcwd()
     grace = 0
     start_time = time.time()
@@ -104,27 +165,42 @@ def do_one_video(link: str) -> list[float]:
     with TemporaryDirectory() as tempdir:
         # chdir guard for the detection square
         os.chdir(tempdir)
-        ssim_scores = [-1.0] * len(IMAGES)
-        with create_process_for_720p_video_for_youtube(link) as process:
+        ssim_scores = np.full(len(BANK), -1.0)
+        frames = 0
+        writer = STORE.writer(link, SQUARE_KEYS, FINGERPRINT, FPS,
+                              STORE_DTYPE) if STORE is not None else None
+        SCORER.reset()
+        SCORER.take_counts()
+        if CLIP_CACHE is None and clip.start is None and clip.end is None:
+            process = create_process_for_720p_video_for_youtube(
+                clip.url, roi=True, fps=FPS)
+        else:
+            try:
+                path = download_youtube_clip(clip, CLIP_CACHE or tempdir)
+            except subprocess.CalledProcessError:
+                logging.error('Link %s: could not download it', link)
+                if writer is not None:
+                    writer.close(complete=False)
+                os.chdir(curr_dir)
+                return link, ssim_scores, 0, timers.take()
+            process = create_process_for_ffmpeg_video(path, roi=True,
+                                                      fps=FPS)
+
+        with process:
             assert process is not None
 
+            reader = RawFrameReader(process.stdout, ROI_LAYOUT.width,
+                                    ROI_LAYOUT.height)
             while process.poll() is None:
-                image_buffer = BytesIO()
+                tick = timers.now()
                 try:
-                    (width, height, _) = ppm_header_parser(process, process.stdout, image_buffer)
+                    (image_array, _, _) = reader.read()
                 except StopIteration:
                     break
+                tick = timers.lap('read', tick)
 
-                image_buffer.write(process.stdout.read(width * height * DEPTH))
-                image_buffer.seek(0)
-
-                # TODO: it's probably possible to directly convert from the buffer stream to numpy
-                image = Image.open(image_buffer)
-                image_array = np.array(image)
-
-                square = image_array[:SQUARE_SIZE,
-                                     (WHOSE_STREAM_SQUARE_NUMBER - 1) * SQUARE_SIZE
-                                     :WHOSE_STREAM_SQUARE_NUMBER * SQUARE_SIZE]
+                square = ROI_LAYOUT.whose_stream_square(image_array,
+                                                        SQUARE_SIZE)
                 ds_diff = calculate_rgb_diff(square, ds)
                 if ds_diff < DETECTOR_THRESHOLD:
                     logging.debug("Link %s: Detection square not found, GRACE: %d, Diff: %d", link, grace, ds_diff)
@@ -135,13 +211,16 @@ def do_one_video(link: str) -> list[float]:
                         break
                 else:
                     grace = 0
+                timers.lap('detector', tick)
 
-                image_array = nparray_crop_frame(image_array, height, width)
-                segments = nparray_segment_into_squares(image_array, SQUARE_SIZE)
-
-                ssim_results = map(process_squares_with_target_image,
-                                   ((segments, tuple) for tuple in IMAGES))
-                ssim_scores = [max(x, y) for x, y in zip(ssim_scores, ssim_results)]
+                scores = SCORER.score(image_array, [active])[0]
+                tick = timers.now()
+                np.maximum(ssim_scores, scores, out=ssim_scores,
+                           where=active)
+                if writer is not None:
+                    writer.append((clip.start or 0) + frames / FPS, scores)
+                timers.lap('reduce', tick)
+                frames += 1
 
                 # DEBUG: Calculate speed
                 if logging.root.isEnabledFor(logging.DEBUG):
@@ -153,17 +232,58 @@ def do_one_video(link: str) -> list[float]:
                         interval_elapsed = time.time()
                         framecount = 0
 
+        if writer is not None:
+            writer.close()
         elapsed = time.time() - start_time
         logging.info('Link %s: finished after %s seconds', link, elapsed)
+        counts = SCORER.take_counts()
+        if counts[3]:
+            logging.info('Link %s: delta gate skipped %d/%d squares (%.1f%%)',
+                         link, counts[4], counts[3],
+                         100.0 * counts[4] / counts[3])
         os.chdir(curr_dir)
-        return ssim_scores
+        return link, ssim_scores, frames, timers.take()
 
 
 # Main
-with Pool() as pool:
-    logging.info('The script will be running on %d processes', pool._processes)
-    logging.info('This will stress your PC!')
-    video_ssim_scores = np.array(pool.map(do_one_video, YOUTUBE_VIDEOS))
+CACHED_SCORES = {link: CACHE.lookup(link, SQUARE_KEYS) if CACHE is not None
+                 else np.full(len(BANK), np.nan)
+                 for link in YOUTUBE_VIDEOS}
+PENDING = [(link, np.isnan(scores)) for link, scores in CACHED_SCORES.items()
+           if np.isnan(scores).any()]
+if STORE is not None:
+    # Stored clips need every square of every frame
+    PENDING = [(link, np.ones(len(BANK), dtype=bool))
+               for link in YOUTUBE_VIDEOS
+               if np.isnan(CACHED_SCORES[link]).any()
+               or not STORE.has(link, SQUARE_KEYS, FINGERPRINT)]
+logging.info('%d/%d videos have squares to score', len(PENDING),
+             len(CACHED_SCORES))
+TIMERS = StageTimers()
+
+if PENDING:
+    with Pool() as pool:
+        logging.info('The script will be running on %d processes',
+                     pool._processes)
+        logging.info('This will stress your PC!')
+        for link, scores, frames, timings in pool.imap_unordered(
+                do_one_video, PENDING):
+            active = np.isnan(CACHED_SCORES[link])
+            CACHED_SCORES[link][active] = scores[active]
+            TIMERS.merge(timings)
+            if CACHE is not None and frames:
+                # Save as we go, so an interrupted run keeps what it did
+                CACHE.store(link, SQUARE_KEYS, scores, active)
+                CACHE.save()
+            elif not frames:
+                logging.warning('Link %s: no frames scored, not caching it',
+                                link)
+
+video_ssim_scores = np.array([CACHED_SCORES[link] for link in YOUTUBE_VIDEOS])
+
+if TIMINGS_FILE:
+    TIMERS.dump(TIMINGS_FILE, {'videos': YOUTUBE_VIDEOS})
+    logging.info('Wrote stage timings to %s', TIMINGS_FILE)
 
 mean = video_ssim_scores.mean(axis=0)
 mins = video_ssim_scores.min(axis=0)
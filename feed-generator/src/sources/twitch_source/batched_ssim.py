@@ -0,0 +1,465 @@
+"""
+Batched SSIM engine.
+
+Scores a whole bank of reference squares against their matching
+squares of a frame in one vectorized NumPy pass, instead of calling
+skimage's `structural_similarity` once per reference.
+
+The maths mirrors `structural_similarity(target, reference,
+channel_axis=2)` with its defaults for uint8 images: a 7x7 uniform
+window, K1 = 0.01, K2 = 0.03, a data range of 255 and the sample
+covariance. skimage filters the whole square and then crops the
+3-pixel border away, so only windows that lie entirely inside the
+square contribute to the mean. Those windows are computed here
+directly with integer summed-area tables, which makes the window sums
+exact; the only differences to skimage are floating point rounding in
+the final divisions. Scores agree with `calculate_ssim` to within
+SSIM_TOLERANCE.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from instrumentation import NULL_TIMERS, StageTimers
+from utils import FrameLayout, SourceImageTuple, SquareGather, brightness_lut
+
+WIN_SIZE = 7
+K1 = 0.01
+K2 = 0.03
+DATA_RANGE = 255
+NP = WIN_SIZE * WIN_SIZE
+COV_NORM = NP / (NP - 1)
+C1 = (K1 * DATA_RANGE) ** 2
+C2 = (K2 * DATA_RANGE) ** 2
+
+# Maximum absolute difference to skimage's structural_similarity
+# observed over the neuro/ and evil/ banks is in the order of 1e-14;
+# this is the bound we promise.
+SSIM_TOLERANCE = 1e-6
+
+# What FrameScorer.counts counts, in order
+COUNT_FIELDS = ('prefilter_candidates', 'prefilter_rejected_luminance',
+                'prefilter_rejected_contrast', 'delta_squares',
+                'delta_unchanged')
+
+
+def window_sums(images: np.ndarray) -> np.ndarray:
+    """
+    Sums every WIN_SIZE x WIN_SIZE window that fits entirely inside
+    each image, per channel.
+
+    Args:
+        images (np.ndarray): Integer images of shape (N, H, W, D)
+
+    Returns:
+        np.ndarray: int64 window sums of shape
+                    (N, H - WIN_SIZE + 1, W - WIN_SIZE + 1, D)
+    """
+    count, height, width, depth = images.shape
+    table = np.zeros((count, height + 1, width + 1, depth), dtype=np.int64)
+    np.cumsum(images, axis=1, dtype=np.int64, out=table[:, 1:, 1:])
+    np.cumsum(table[:, 1:, 1:], axis=2, out=table[:, 1:, 1:])
+    return (table[:, WIN_SIZE:, WIN_SIZE:] - table[:, :-WIN_SIZE, WIN_SIZE:]
+            - table[:, WIN_SIZE:, :-WIN_SIZE]
+            + table[:, :-WIN_SIZE, :-WIN_SIZE])
+
+
+def ssim_moments(images: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the windowed mean and sample variance of some images.
+
+    Args:
+        images (np.ndarray): uint8 images of shape (N, H, W, D)
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The windowed means and
+                                       variances, both float64
+    """
+    wide = images.astype(np.int64)
+    mean = window_sums(wide) / NP
+    variance = COV_NORM * (window_sums(wide * wide) / NP - mean * mean)
+    return mean, variance
+
+
+def ssim_from_moments(targets: np.ndarray, references: np.ndarray,
+                      target_moments: tuple[np.ndarray, np.ndarray],
+                      reference_moments: tuple[np.ndarray, np.ndarray],
+                      ) -> np.ndarray:
+    """
+    Computes the SSIM of each target against the reference at the same
+    position, given the moments of both.
+
+    Args:
+        targets (np.ndarray): uint8 targets of shape (N, S, S, D)
+        references (np.ndarray): uint8 references of the same shape
+        target_moments (tuple[np.ndarray, np.ndarray]): ssim_moments()
+                                                        of the targets
+        reference_moments (tuple[np.ndarray, np.ndarray]): ssim_moments()
+                                                           of the references
+
+    Returns:
+        np.ndarray: float64 SSIM scores of shape (N,)
+    """
+    mean_x, var_x = target_moments
+    mean_y, var_y = reference_moments
+    cross = window_sums(targets.astype(np.int64) * references) / NP
+    covariance = COV_NORM * (cross - mean_x * mean_y)
+
+    numerator = (2 * mean_x * mean_y + C1) * (2 * covariance + C2)
+    denominator = ((mean_x * mean_x + mean_y * mean_y + C1)
+                   * (var_x + var_y + C2))
+    return (numerator / denominator).mean(axis=(1, 2, 3))
+
+
+def batched_ssim(targets: np.ndarray, references: np.ndarray) -> np.ndarray:
+    """
+    Computes the SSIM of each target against the reference at the same
+    position.
+
+    Args:
+        targets (np.ndarray): uint8 targets of shape (N, S, S, D)
+        references (np.ndarray): uint8 references of the same shape
+
+    Returns:
+        np.ndarray: float64 SSIM scores of shape (N,)
+    """
+    return ssim_from_moments(targets, references, ssim_moments(targets),
+                             ssim_moments(references))
+
+
+class SquareMoments:
+    """
+    The frame-side SSIM moments of a batch of squares, computed once on
+    first use and then shared by every reference of every bank that
+    looks at those squares. The means and the variances are computed
+    separately, so a prefilter that only needs the means does not pay
+    for the variances.
+    """
+    def __init__(self, squares: np.ndarray) -> None:
+        self.squares = squares
+        self.wide = squares.astype(np.int64)
+        self._mean: Optional[np.ndarray] = None
+        self._variance: Optional[np.ndarray] = None
+
+    @property
+    def mean(self) -> np.ndarray:
+        """
+        The windowed means of the squares, as in ssim_moments()
+        """
+        if self._mean is None:
+            self._mean = window_sums(self.wide) / NP
+        return self._mean
+
+    @property
+    def variance(self) -> np.ndarray:
+        """
+        The windowed sample variances of the squares, as in
+        ssim_moments()
+        """
+        if self._variance is None:
+            mean = self.mean
+            self._variance = COV_NORM * (window_sums(self.wide * self.wide)
+                                         / NP - mean * mean)
+        return self._variance
+
+
+@dataclass
+class ReferenceBank:
+    """
+    A bank of reference squares stacked into contiguous arrays, with
+    their SSIM moments computed once up front.
+
+    Banks loaded through reference_bank.load_bank also carry their
+    (mean, min) thresholds and the content hash of their sources.
+    """
+    square_numbers: np.ndarray
+    pixels: np.ndarray
+    mean: np.ndarray
+    variance: np.ndarray
+    thresholds: Optional[np.ndarray] = None
+    content_hash: Optional[str] = None
+
+    @classmethod
+    def from_images(cls, images: list[SourceImageTuple]) -> 'ReferenceBank':
+        """
+        Stacks a list of SourceImageTuples into a bank.
+
+        Args:
+            images (list[SourceImageTuple]): The reference images
+
+        Returns:
+            ReferenceBank: The bank
+        """
+        square_numbers = np.array([image.square_number for image in images],
+                                  dtype=np.intp)
+        pixels = np.ascontiguousarray(
+            np.stack([image.array for image in images]), dtype=np.uint8)
+        mean, variance = ssim_moments(pixels)
+        return cls(square_numbers, pixels, mean, variance)
+
+    def __len__(self) -> int:
+        return len(self.square_numbers)
+
+    def score(self, squares: np.ndarray,
+              positions: Optional[np.ndarray] = None,
+              subset: Optional[np.ndarray] = None,
+              moments: Optional[SquareMoments] = None) -> np.ndarray:
+        """
+        Scores every reference against its square.
+
+        Args:
+            squares (np.ndarray): A batch of squares of a frame, e.g.
+                                  from a SquareGather
+            positions (Optional[np.ndarray]): Where the square of each
+                reference is in squares. Defaults to the square
+                numbers, i.e. squares holding every square of the grid
+                as returned by nparray_segment_into_squares
+            subset (Optional[np.ndarray]): Indices of the references to
+                                           score. Defaults to all
+            moments (Optional[SquareMoments]): The moments of squares,
+                if they are shared with other banks. Otherwise only the
+                moments of the squares that get scored are computed
+
+        Returns:
+            np.ndarray: float64 SSIM scores, one per (scored) reference
+        """
+        if positions is None:
+            positions = self.square_numbers
+        if subset is None:
+            subset = np.arange(len(self))
+
+        targets = positions[subset]
+        if moments is None:
+            target_moments = ssim_moments(squares[targets])
+        else:
+            target_moments = (moments.mean[targets], moments.variance[targets])
+        return ssim_from_moments(squares[targets], self.pixels[subset],
+                                 target_moments,
+                                 (self.mean[subset], self.variance[subset]))
+
+
+    def score_cascade(self, squares: np.ndarray, positions: np.ndarray,
+                      subset: np.ndarray, cutoffs: np.ndarray,
+                      moments: Optional[SquareMoments] = None
+                      ) -> tuple[np.ndarray, int, int]:
+        """
+        Scores references against their squares, skipping the exact SSIM
+        of those that provably score below their cutoff.
+
+        Per window, SSIM is the luminance term l times the contrast
+        structure term cs, with 0 < l <= 1 and cs <= 1. The first stage
+        bounds the score by the mean of l, which only needs the window
+        means of the targets. The second stage bounds cs by replacing
+        the covariance with sqrt(var_x * var_y) (Cauchy-Schwarz), which
+        also needs the variances but no cross products. References
+        whose bound is below the cutoff by more than SSIM_TOLERANCE are
+        rejected; the others get the exact score, computed from the
+        same moments, so they are bit for bit what score() returns.
+
+        Args:
+            squares (np.ndarray): A batch of squares of a frame
+            positions (np.ndarray): Where the square of each reference
+                                    is in squares
+            subset (np.ndarray): Indices of the references to score
+            cutoffs (np.ndarray): The cutoff of every reference
+            moments (Optional[SquareMoments]): The moments of squares,
+                                               if shared with other banks
+
+        Returns:
+            tuple[np.ndarray, int, int]: The scores over subset, -inf
+                for rejected references, then how many the first and
+                second stages rejected
+        """
+        if moments is None:
+            moments = SquareMoments(squares[positions[subset]])
+            targets = np.arange(len(subset))
+        else:
+            targets = positions[subset]
+        mean_x = moments.mean[targets]
+        mean_y = self.mean[subset]
+        luminance = ((2 * mean_x * mean_y + C1)
+                     / (mean_x * mean_x + mean_y * mean_y + C1))
+        first = (luminance.mean(axis=(1, 2, 3)) + SSIM_TOLERANCE
+                 >= cutoffs[subset]).nonzero()[0]
+
+        mean_x = mean_x[first]
+        var_x = moments.variance[targets[first]]
+        var_y = self.variance[subset[first]]
+        contrast = ((2 * np.sqrt(np.maximum(var_x, 0) * np.maximum(var_y, 0))
+                     + C2) / (var_x + var_y + C2))
+        second = ((luminance[first] * contrast).mean(axis=(1, 2, 3))
+                  + SSIM_TOLERANCE >= cutoffs[subset[first]]).nonzero()[0]
+
+        kept = subset[first[second]]
+        scores = np.full(len(subset), -np.inf)
+        scores[first[second]] = ssim_from_moments(
+            moments.squares[targets[first[second]]], self.pixels[kept],
+            (mean_x[second], var_x[second]),
+            (self.mean[kept], self.variance[kept]))
+        return (scores, len(subset) - len(first), len(first) - len(second))
+
+
+class FrameScorer:
+    """
+    Scores every bank against a frame: gathers the squares all banks
+    look at once, brightness-adjusts only those with each bank's gain,
+    computes their SSIM moments once per gain, then runs one batched
+    SSIM pass per bank that only adds the cross terms.
+
+    Given cutoffs, references go through ReferenceBank.score_cascade
+    instead, and those that cannot reach their cutoff score -inf.
+
+    Given a delta_tolerance, the scorer keeps the squares of the last
+    frame it scored. References whose square has no pixel that moved
+    by more than delta_tolerance since then get their last score again
+    instead of being rescored. With a tolerance of 0 this changes
+    nothing but the work done.
+
+    counts accumulates, in the order of COUNT_FIELDS, how many
+    references the prefilter considered and rejected in each stage, and
+    how many squares the delta gate looked at and found unchanged.
+    timers, if set to a StageTimers, times the gather, delta, adjust and
+    ssim stages of every frame.
+    """
+    def __init__(self, banks: list[ReferenceBank], layout: FrameLayout,
+                 square_size: int = 20,
+                 gains: Optional[list[float]] = None,
+                 cutoffs: Optional[list[np.ndarray]] = None,
+                 delta_tolerance: Optional[int] = None) -> None:
+        self.banks = banks
+        self.gather = SquareGather(
+            np.concatenate([bank.square_numbers for bank in banks]),
+            layout, square_size)
+        self.positions = [self.gather.positions(bank.square_numbers)
+                          for bank in banks]
+        self.gains = gains or [1.0] * len(banks)
+        self.luts = {gain: brightness_lut(gain) for gain in set(self.gains)
+                     if gain != 1.0}
+        self.cutoffs = cutoffs
+        self.delta_tolerance = delta_tolerance
+        self.previous: Optional[np.ndarray] = None
+        # NaN until a reference is scored, and again once its square changes
+        self.last_scores = [np.full(len(bank), np.nan) for bank in banks]
+        self.counts = np.zeros(len(COUNT_FIELDS), dtype=np.int64)
+        self.timers: StageTimers = NULL_TIMERS
+
+    def adjust(self, pixels: np.ndarray, gain: float) -> np.ndarray:
+        """
+        Brightness-adjusts some pixels by one of the bank gains.
+
+        Args:
+            pixels (np.ndarray): uint8 pixels
+            gain (float): The gain
+
+        Returns:
+            np.ndarray: The adjusted pixels, or pixels itself for 1.0
+        """
+        if gain == 1.0:
+            return pixels
+        return self.luts[gain][pixels]
+
+    def reset(self) -> None:
+        """
+        Forgets the last frame, e.g. before starting on another video.
+        """
+        self.previous = None
+        for last in self.last_scores:
+            last.fill(np.nan)
+
+    def _changed(self, gathered: np.ndarray) -> Optional[np.ndarray]:
+        if self.delta_tolerance is None:
+            return None
+
+        if self.previous is None:
+            self.previous = gathered.copy()
+            self.counts[3] += len(gathered)
+            return np.ones(len(gathered), dtype=bool)
+
+        if self.delta_tolerance == 0:
+            changed = (gathered != self.previous).any(axis=(1, 2, 3))
+        else:
+            changed = (np.abs(gathered.astype(np.int16) - self.previous)
+                       > self.delta_tolerance).any(axis=(1, 2, 3))
+        # Unchanged squares keep the pixels their last score is for, so
+        # slow drifts still add up past the tolerance
+        self.previous[changed] = gathered[changed]
+        self.counts[3:] += (len(changed), len(changed) - changed.sum())
+        return changed
+
+    def score(self, frame: np.ndarray,
+              active: Optional[list[np.ndarray]] = None
+              ) -> list[np.ndarray]:
+        """
+        Scores a frame.
+
+        Args:
+            frame (np.ndarray): A frame as decoded, in the layout given
+                                to the constructor
+            active (Optional[list[np.ndarray]]): A boolean mask per
+                bank of the references to score. The others score
+                -inf. Defaults to all
+
+        Returns:
+            list[np.ndarray]: The SSIM scores of each bank
+        """
+        tick = self.timers.now()
+        gathered = self.gather.gather(frame)
+        tick = self.timers.lap('gather', tick)
+        changed = self._changed(gathered)
+        tick = self.timers.lap('delta', tick)
+        # Frame-side moments are computed once per distinct gain and
+        # shared by every bank, e.g. neuro and evil in panic mode
+        moments = {gain: SquareMoments(self.adjust(gathered, gain))
+                   for gain in set(self.gains)}
+        tick = self.timers.lap('adjust', tick)
+
+        results = []
+        for idx, (bank, positions, gain) in enumerate(
+                zip(self.banks, self.positions, self.gains)):
+            squares = moments[gain].squares
+            mask = active[idx] if active is not None else None
+            if self.cutoffs is None and changed is None and \
+               (mask is None or mask.all()):
+                results.append(bank.score(squares, positions,
+                                          moments=moments[gain]))
+                continue
+
+            scores = np.full(len(bank), -np.inf)
+            if changed is not None:
+                last = self.last_scores[idx]
+                last[changed[positions]] = np.nan
+                reuse = ~np.isnan(last)
+                if mask is not None:
+                    reuse &= mask
+                scores[reuse] = last[reuse]
+                mask = ~reuse if mask is None else mask & ~reuse
+
+            subset = np.arange(len(bank)) if mask is None \
+                else np.flatnonzero(mask)
+            if len(subset) and self.cutoffs is None:
+                scores[subset] = bank.score(squares, positions, subset,
+                                            moments[gain])
+            elif len(subset):
+                scores[subset], first, second = bank.score_cascade(
+                    squares, positions, subset, self.cutoffs[idx],
+                    moments[gain])
+                self.counts[:3] += (len(subset), first, second)
+
+            if changed is not None:
+                self.last_scores[idx][subset] = scores[subset]
+            results.append(scores)
+        self.timers.lap('ssim', tick)
+        return results
+
+    def take_counts(self) -> np.ndarray:
+        """
+        Gets counts and resets it.
+
+        Returns:
+            np.ndarray: The counts, in the order of COUNT_FIELDS
+        """
+        counts = self.counts
+        self.counts = np.zeros(len(COUNT_FIELDS), dtype=np.int64)
+        return counts
@@ -0,0 +1,445 @@
+"""
+Offline benchmark of the scrutinize pipeline.
+
+Synthesizes a stream locally by compositing the reference squares of a
+bank into frames, encodes it losslessly at each resolution with ffmpeg,
+and then reads it back through create_process_for_ffmpeg_video like a
+real recording. A local recording can be given with --video instead.
+
+Every stage of the hot loop is timed per frame (reading a frame off the
+pipe, gathering the squares, brightness adjustment, SSIM scoring) as
+the frames stream out of the decoder, followed by the end-to-end
+scrutinize_with_images_and_thresholds. Frames are never all held in
+memory, and every video is benchmarked in a fresh process, so its peak
+RSS is the one of the pipeline alone. The report holds the fps and
+latency percentiles of every stage and the peak RSS of every video, as
+JSON:
+
+    python3 benchmark.py --report benchmark_report.json
+
+Timings only compare on the same machine, so no baseline is committed.
+To check a change, save a baseline on the commit before it, and compare
+the change against it. The comparison fails (exit code 1) if a stage got
+slower by more than --tolerance:
+
+    git stash
+    python3 benchmark.py --save-baseline benchmark_baseline.json
+    git stash pop
+    python3 benchmark.py --baseline benchmark_baseline.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+from batched_ssim import FrameScorer, ReferenceBank
+from reference_bank import load_bank
+from scrutinize import (ScrutinizeOptions, ScrutinizeStats,
+                        create_frame_reader,
+                        scrutinize_with_images_and_thresholds)
+from utils import (EXPECTED_HEIGHT, EXPECTED_WIDTH, ROI_LAYOUT, FrameLayout,
+                   SquareGather, brightness_lut,
+                   create_process_for_ffmpeg_video, full_frame_layout)
+
+REPORT_VERSION = 2
+SQUARE_SIZE = 20
+FPS = 30
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080)}
+PERCENTILES = (50, 90, 99)
+BENCHMARK_GAIN = 1.2
+REFERENCE_HOLD = 10  # frames each reference square stays on screen
+
+
+def synthesize_frames(bank: ReferenceBank, count: int,
+                      seed: int = 0) -> Iterator[np.ndarray]:
+    """
+    Synthesizes 720p frames: a drifting noisy background with a fixed
+    dynamic detector square, over which the reference squares of the
+    bank are composited in turn, REFERENCE_HOLD frames each.
+
+    Args:
+        bank (ReferenceBank): The bank
+        count (int): The number of frames
+        seed (int): The random seed
+
+    Returns:
+        Iterator[np.ndarray]: The (720, 1280, 3) frames. The same array
+                              is reused for every frame
+    """
+    rng = np.random.default_rng(seed)
+    layout = full_frame_layout(EXPECTED_WIDTH, EXPECTED_HEIGHT, SQUARE_SIZE)
+    gather = SquareGather(bank.square_numbers, layout, SQUARE_SIZE)
+    positions = gather.positions(bank.square_numbers)
+
+    background = rng.integers(0, 256, (EXPECTED_HEIGHT, EXPECTED_WIDTH * 2, 3),
+                              dtype=np.uint8)
+    detector = rng.integers(0, 256, (SQUARE_SIZE, SQUARE_SIZE, 3),
+                            dtype=np.uint8)
+    top, left = layout.dynamic_detector
+
+    frame = np.empty((EXPECTED_HEIGHT, EXPECTED_WIDTH, 3), dtype=np.uint8)
+    for idx in range(count):
+        shift = (idx * 4) % EXPECTED_WIDTH
+        frame[:] = background[:, shift:shift + EXPECTED_WIDTH]
+        frame[top:top + SQUARE_SIZE, left:left + SQUARE_SIZE] = detector
+
+        reference = (idx // REFERENCE_HOLD) % len(bank)
+        pixels = frame.reshape(-1, 3)
+        pixels[gather.index[positions[reference]].ravel()] = \
+            bank.pixels[reference].reshape(-1, 3)
+        yield frame
+
+
+def encode_video(frames: Iterator[np.ndarray], path: str, width: int,
+                 height: int) -> None:
+    """
+    Encodes frames losslessly (FFV1) at a resolution, streaming them to
+    ffmpeg.
+
+    Args:
+        frames (Iterator[np.ndarray]): 720p frames
+        path (str): The output, e.g. a .mkv file
+        width (int): The output width
+        height (int): The output height
+
+    Throws:
+        subprocess.CalledProcessError: If ffmpeg failed
+    """
+    command = ['ffmpeg', '-loglevel', 'error', '-y',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', f'{EXPECTED_WIDTH}x{EXPECTED_HEIGHT}',
+               '-r', str(FPS), '-i', '-',
+               '-vf', f'scale={width}:{height}:flags=neighbor',
+               '-c:v', 'ffv1', '-pix_fmt', 'bgr0', path]
+    with subprocess.Popen(command, stdin=subprocess.PIPE) as process:
+        assert process.stdin is not None
+        for frame in frames:
+            process.stdin.write(frame.tobytes())
+        process.stdin.close()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def summarize(samples: list[float]) -> dict:
+    """
+    Summarizes per-frame latencies.
+
+    Args:
+        samples (list[float]): Latencies, in seconds
+
+    Returns:
+        dict: The count, mean and percentiles in milliseconds, and fps
+    """
+    latencies = np.array(samples) * 1000.0
+    summary = {'count': len(samples),
+               'mean_ms': float(latencies.mean()) if len(samples) else 0.0,
+               'fps': (len(samples) / float(np.sum(samples))
+                       if len(samples) and np.sum(samples) else 0.0)}
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}_ms'] = \
+            float(np.percentile(latencies, percentile)) if len(samples) \
+            else 0.0
+    return summary
+
+
+def time_stages(path: str, layout: Optional[FrameLayout],
+                make_stages: Callable[[FrameLayout],
+                                      dict[str, Callable[[np.ndarray],
+                                                         object]]]
+                ) -> tuple[int, np.ndarray, dict]:
+    """
+    Streams every frame of a video out of ffmpeg, timing its read and
+    then every stage on it, before reading the next one.
+
+    Args:
+        path (str): The video
+        layout (Optional[FrameLayout]): ROI_LAYOUT for ROI mode, None
+                                        for PPM
+        make_stages (Callable[[FrameLayout], dict[str, Callable[
+            [np.ndarray], object]]]): Makes the stages, by name, once the
+                                      layout of the frames is known
+
+    Returns:
+        tuple[int, np.ndarray, dict]: The number of frames, a copy of
+                                      the first one, and the summary of
+                                      every stage
+
+    Throws:
+        ValueError: If the video has no frames
+    """
+    first_frame: Optional[np.ndarray] = None
+    stages: dict[str, Callable[[np.ndarray], object]] = {}
+    samples: dict[str, list[float]] = {'read': []}
+    with create_process_for_ffmpeg_video(path, roi=layout is not None) \
+            as process:
+        reader = create_frame_reader(process, layout)
+        while True:
+            start = time.perf_counter()
+            try:
+                frame, width, height = reader.read()
+            except StopIteration:
+                break
+            samples['read'].append(time.perf_counter() - start)
+
+            if first_frame is None:
+                first_frame = frame.copy()
+                stages = make_stages(layout or full_frame_layout(
+                    width, height, SQUARE_SIZE))
+                samples.update({name: [] for name in stages})
+            for name, function in stages.items():
+                start = time.perf_counter()
+                function(frame)
+                samples[name].append(time.perf_counter() - start)
+
+    if first_frame is None:
+        raise ValueError(f'{path} has no frames')
+    return (len(samples['read']), first_frame,
+            {name: summarize(latencies)
+             for name, latencies in samples.items()})
+
+
+def benchmark_video(path: str, bank: ReferenceBank,
+                    layout: Optional[FrameLayout],
+                    options: ScrutinizeOptions) -> dict:
+    """
+    Benchmarks every stage and the end-to-end loop on one video.
+
+    Args:
+        path (str): The video
+        bank (ReferenceBank): The bank to score
+        layout (Optional[FrameLayout]): ROI_LAYOUT for ROI mode, None
+                                        for PPM
+        options (ScrutinizeOptions): The scrutinize options
+
+    Returns:
+        dict: The stage summaries and end-to-end numbers
+    """
+    frame_layout = layout
+
+    def make_stages(stage_layout: FrameLayout
+                    ) -> dict[str, Callable[[np.ndarray], object]]:
+        nonlocal frame_layout
+        frame_layout = stage_layout
+        gather = SquareGather(bank.square_numbers, stage_layout, SQUARE_SIZE)
+        positions = gather.positions(bank.square_numbers)
+        lut = brightness_lut(BENCHMARK_GAIN)
+        plain = FrameScorer([bank], stage_layout, SQUARE_SIZE)
+        scorer = FrameScorer([bank], stage_layout, SQUARE_SIZE,
+                             [BENCHMARK_GAIN],
+                             [bank.thresholds[:, 1]]
+                             if bank.thresholds is not None else None,
+                             options.delta_tolerance)
+        return {
+            'gather': gather.gather,
+            'adjust': lambda frame: lut[gather.gather(frame)],
+            'ssim': lambda frame: bank.score(gather.gather(frame), positions),
+            'score': plain.score,
+            'score_filtered': scorer.score,
+        }
+
+    frame_count, first_frame, stages = time_stages(path, layout,
+                                                   make_stages)
+    assert frame_layout is not None
+    detector_square = frame_layout.dynamic_detector_square(first_frame,
+                                                           SQUARE_SIZE)
+    thresholds = bank.thresholds if bank.thresholds is not None \
+        else np.zeros((len(bank), 2))
+    stats = ScrutinizeStats()
+    start = time.perf_counter()
+    with create_process_for_ffmpeg_video(path, roi=layout is not None) \
+            as process:
+        scrutinize_with_images_and_thresholds(
+            process, [bank], [thresholds], [detector_square], 1.0, layout,
+            options, stats)
+    elapsed = time.perf_counter() - start
+
+    return {'frames': frame_count, 'stages': stages,
+            'end_to_end': {'seconds': elapsed,
+                           'frames_read': stats.frames_read,
+                           'fps': stats.frames_read / elapsed,
+                           'stats': stats.summary()}}
+
+
+def peak_rss_kb() -> dict:
+    """
+    Gets the peak RSS of this process and of its children (ffmpeg).
+
+    Returns:
+        dict: The peaks, in KiB
+    """
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def benchmark_configuration(path: str, bank_directory: str,
+                            thresholds: str, roi: bool,
+                            options: ScrutinizeOptions) -> dict:
+    """
+    Benchmarks one video, and measures the peak RSS of doing so. Meant
+    to run in a process of its own (see run_isolated), so the peak is
+    the one of this video only.
+
+    Args:
+        path (str): The video
+        bank_directory (str): The bank directory
+        thresholds (str): The thresholds file
+        roi (bool): Whether to pipe ROI rawvideo instead of PPM frames
+        options (ScrutinizeOptions): The scrutinize options
+
+    Returns:
+        dict: benchmark_video() of the video, plus its 'peak_rss_kb'
+    """
+    bank = load_bank(bank_directory, thresholds)
+    run = benchmark_video(path, bank, ROI_LAYOUT if roi else None, options)
+    run['peak_rss_kb'] = peak_rss_kb()
+    return run
+
+
+def run_isolated(function: Callable[..., dict], *args: object) -> dict:
+    """
+    Runs a function in a freshly spawned process. Spawned, not forked,
+    so that the process does not start with the memory of this one.
+
+    Args:
+        function (Callable[..., dict]): The function
+        *args (object): Its arguments
+
+    Returns:
+        dict: Its result
+    """
+    with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compares a report against a baseline.
+
+    Args:
+        report (dict): The report
+        baseline (dict): The baseline report
+        tolerance (float): The allowed slowdown, e.g. 0.2 for 20%
+
+    Returns:
+        list[str]: The regressions, empty if there are none
+    """
+    regressions = []
+    for name, run in report['runs'].items():
+        base = baseline.get('runs', {}).get(name)
+        if base is None:
+            continue
+        for stage, summary in run['stages'].items():
+            base_stage = base['stages'].get(stage)
+            if base_stage is None:
+                continue
+            limit = base_stage['p50_ms'] * (1 + tolerance)
+            if summary['p50_ms'] > limit:
+                regressions.append(
+                    f'{name} {stage}: p50 {summary["p50_ms"]:.3f} ms > '
+                    f'{limit:.3f} ms (baseline {base_stage["p50_ms"]:.3f} ms)')
+        limit = base['end_to_end']['fps'] / (1 + tolerance)
+        if run['end_to_end']['fps'] < limit:
+            regressions.append(
+                f'{name} end to end: {run["end_to_end"]["fps"]:.1f} fps < '
+                f'{limit:.1f} fps (baseline '
+                f'{base["end_to_end"]["fps"]:.1f} fps)')
+    return regressions
+
+
+def main() -> int:
+    """
+    Runs the benchmark.
+
+    Returns:
+        int: The exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--bank', default='neuro')
+    parser.add_argument('--thresholds', default='neuro.npz')
+    parser.add_argument('--video', help='benchmark a local recording '
+                        'instead of synthesized streams')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--resolutions', nargs='+', default=list(RESOLUTIONS),
+                        choices=list(RESOLUTIONS))
+    parser.add_argument('--roi', action='store_true',
+                        help='pipe ROI rawvideo instead of PPM frames')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--report', default='benchmark_report.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    bank = load_bank(args.bank, args.thresholds)
+    # A recording may lose its detector square for a moment; keep going,
+    # the point is to time the whole video
+    options = ScrutinizeOptions(fps=FPS, workers=args.workers,
+                                grace_period=float('inf'))
+
+    runs = {}
+    with TemporaryDirectory() as tempdir:
+        if args.video:
+            videos = {os.path.basename(args.video): args.video}
+        else:
+            videos = {}
+            for name in args.resolutions:
+                videos[name] = os.path.join(tempdir, f'{name}.mkv')
+                encode_video(synthesize_frames(bank, args.frames),
+                             videos[name], *RESOLUTIONS[name])
+
+        for name, path in videos.items():
+            logging.info('Benchmarking %s', name)
+            runs[name] = run_isolated(benchmark_configuration, path,
+                                      args.bank, args.thresholds, args.roi,
+                                      options)
+
+    report = {'version': REPORT_VERSION, 'created_at': time.time(),
+              'roi': args.roi, 'workers': args.workers, 'runs': runs}
+    with open(args.report, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    logging.info('Wrote %s', args.report)
+
+    for name, run in runs.items():
+        for stage, summary in run['stages'].items():
+            print(f'{name:>6} {stage:<15} p50 {summary["p50_ms"]:8.3f} ms  '
+                  f'p99 {summary["p99_ms"]:8.3f} ms  '
+                  f'{summary["fps"]:9.1f} fps')
+        print(f'{name:>6} {"end to end":<15} '
+              f'{run["end_to_end"]["fps"]:38.1f} fps')
+        print(f'{name:>6} {"peak RSS":<15} '
+              f'{run["peak_rss_kb"]["self"]:>10} KiB, ffmpeg '
+              f'{run["peak_rss_kb"]["children"]} KiB')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+        logging.info('Saved the baseline to %s', args.save_baseline)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            logging.error('Regression: %s', regression)
+        if regressions:
+            return 1
+        logging.info('No regressions against %s', args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""
+Calibrates the thresholds of a bank from the scores analyze.py stored.
+
+A square counts as found once its score reaches the min of its
+thresholds. Instead of taking the min over the training clips, this
+searches a grid of candidate cutoffs for every square at once, against
+positive clips (where the square should be found) and negative clips
+(where it should not, e.g. the training clips of the other streamer,
+analyzed against this bank with their own detection square).
+
+The cutoff of a square is the middle of the best plateau of
+
+    detection rate - FALSE_MATCH_WEIGHT * false-match rate
+
+over the candidates. It is validated with leave-one-clip-out: every
+clip is held out in turn, the cutoff is chosen again from the other
+clips, and the held-out clip is checked against it. All of this is a
+few array operations over (clips, squares, candidates).
+
+The best score of every square over every clip is read from the score
+cache of analyze.py, or from its frame-level score store (--store). The
+output has the same format as analyze.py, so load_thresholds() reads it:
+
+    python3 calibrate.py neuro neuro_training_clips.txt \\
+        evil_training_clips.txt --output neuro.npz
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from reference_bank import load_bank
+from score_cache import ScoreCache, square_keys
+from score_store import ScoreStore
+
+CANDIDATES = 2001
+FALSE_MATCH_WEIGHT = 1.0
+
+
+def read_clips(filename: str) -> list[str]:
+    """
+    Reads a clips list, one clip per line.
+
+    Args:
+        filename (str): The file
+
+    Returns:
+        list[str]: The clips
+    """
+    with open(filename, encoding='utf8') as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+
+def best_scores_from_cache(cache: ScoreCache, clips: list[str],
+                           keys: list[str]) -> np.ndarray:
+    """
+    Gets the best score of every square over every clip from the cache.
+
+    Args:
+        cache (ScoreCache): The cache
+        clips (list[str]): The clips
+        keys (list[str]): The keys of the squares
+
+    Returns:
+        np.ndarray: (clips, squares) scores, NaN where missing
+    """
+    return np.array([cache.lookup(clip, keys) for clip in clips]) \
+        .reshape(len(clips), len(keys))
+
+
+def best_scores_from_store(store: ScoreStore, clips: list[str],
+                           keys: list[str]) -> np.ndarray:
+    """
+    Gets the best score of every square over every clip from the score
+    store.
+
+    Args:
+        store (ScoreStore): The store
+        clips (list[str]): The clips
+        keys (list[str]): The keys of the squares
+
+    Returns:
+        np.ndarray: (clips, squares) scores, NaN where missing
+    """
+    best = np.full((len(clips), len(keys)), np.nan)
+    for idx, clip in enumerate(clips):
+        clip_scores = store.open(clip, keys)
+        if clip_scores is None or not len(clip_scores):
+            continue
+        columns = clip_scores.columns(keys)
+        found = columns >= 0
+        best[idx, found] = clip_scores.scores.max(axis=0)[columns[found]]
+    return best
+
+
+def choose(objective: np.ndarray, candidates: np.ndarray,
+           top: np.ndarray) -> np.ndarray:
+    """
+    Chooses the middle of the first plateau of maxima along the last
+    axis, i.e. the cutoff furthest from both kinds of errors.
+
+    Args:
+        objective (np.ndarray): (..., candidates) objective
+        candidates (np.ndarray): The candidates
+        top (np.ndarray): Where to choose the top of the plateau
+                          instead, i.e. the highest cutoff that still
+                          detects as much. Broadcast against (...)
+
+    Returns:
+        np.ndarray: (...) chosen candidates
+    """
+    best = objective >= objective.max(axis=-1, keepdims=True) - 1e-6
+    first = best.argmax(axis=-1)
+    # The plateau ends at the first candidate past `first` that is not
+    # one of the maxima
+    best |= np.arange(len(candidates)) < first[..., None]
+    end = np.where(best.all(axis=-1), len(candidates), best.argmin(axis=-1))
+    return candidates[np.where(top, end - 1, (first + end - 1) // 2)]
+
+
+def rates(positives: np.ndarray, negatives: np.ndarray,
+          candidates: np.ndarray) -> tuple[np.ndarray, np.ndarray,
+                                           np.ndarray, np.ndarray]:
+    """
+    Counts hits of every candidate.
+
+    Args:
+        positives (np.ndarray): (positive clips, squares) best scores
+        negatives (np.ndarray): (negative clips, squares) best scores
+        candidates (np.ndarray): The candidates
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+            (positive clips, squares, candidates) positive hits,
+            (negative clips, squares, candidates) negative hits and the
+            (clips, squares) masks of the scores that are not missing
+    """
+    positive_hits = positives[:, :, None] >= candidates
+    negative_hits = negatives[:, :, None] >= candidates
+    return (positive_hits, negative_hits, ~np.isnan(positives),
+            ~np.isnan(negatives))
+
+
+def calibrate(positives: np.ndarray, negatives: np.ndarray,
+              candidates: np.ndarray,
+              false_match_weight: float = FALSE_MATCH_WEIGHT) -> dict:
+    """
+    Chooses the cutoff of every square, and validates it with
+    leave-one-clip-out.
+
+    Args:
+        positives (np.ndarray): (positive clips, squares) best scores
+        negatives (np.ndarray): (negative clips, squares) best scores
+        candidates (np.ndarray): The candidates, ascending
+        false_match_weight (float): How much a false match costs,
+                                    relative to a missed detection
+
+    Returns:
+        dict: The 'cutoffs' of every square, and per square the
+              in-sample and leave-one-clip-out 'detection' and
+              'false_match' rates
+    """
+    positive_hits, negative_hits, positive_valid, negative_valid = \
+        rates(positives, negatives, candidates)
+    # float32 halves the memory traffic of the (clips, squares,
+    # candidates) arrays, and is plenty to rank rates
+    true_matches = positive_hits.sum(axis=0, dtype=np.float32)
+    false_matches = negative_hits.sum(axis=0, dtype=np.float32)
+    positive_count = positive_valid.sum(axis=0, dtype=np.float32)[:, None]
+    negative_count = negative_valid.sum(axis=0, dtype=np.float32)[:, None]
+    weight = np.float32(false_match_weight)
+
+    def objective(true_matches, positive_count, false_matches,
+                  negative_count):
+        return true_matches / np.maximum(positive_count, 1) \
+            - weight * false_matches / np.maximum(negative_count, 1)
+
+    # Without negative clips, there is no false match to stay away from
+    top = negative_count[:, 0] == 0
+    cutoffs = choose(objective(true_matches, positive_count, false_matches,
+                               negative_count), candidates, top)
+
+    # Leave one positive clip out: its hits leave the counts
+    held_out_cutoffs = choose(objective(
+        true_matches - positive_hits,
+        positive_count - positive_valid[:, :, None],
+        false_matches, negative_count), candidates, top)
+    detected = (positives >= held_out_cutoffs) & positive_valid
+
+    # Leave one negative clip out
+    held_out_cutoffs = choose(objective(
+        true_matches, positive_count,
+        false_matches - negative_hits,
+        negative_count - negative_valid[:, :, None]), candidates,
+        negative_count[:, 0] - negative_valid == 0)
+    false_matched = (negatives >= held_out_cutoffs) & negative_valid
+
+    positive_total = np.maximum(positive_valid.sum(axis=0), 1)
+    negative_total = np.maximum(negative_valid.sum(axis=0), 1)
+    return {
+        'cutoffs': cutoffs,
+        'detection': ((positives >= cutoffs) & positive_valid).sum(axis=0)
+                     / positive_total,
+        'false_match': ((negatives >= cutoffs) & negative_valid).sum(axis=0)
+                       / negative_total,
+        'loo_detection': detected.sum(axis=0) / positive_total,
+        'loo_false_match': false_matched.sum(axis=0) / negative_total,
+    }
+
+
+def main() -> int:
+    """
+    Runs the calibration.
+
+    Returns:
+        int: The exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('bank', help='the bank directory, e.g. neuro')
+    parser.add_argument('positives', help='clips the squares should match')
+    parser.add_argument('negatives', help='clips the squares should not '
+                        'match')
+    parser.add_argument('--cache', default='analyze_cache.json')
+    parser.add_argument('--store', help='read the frame-level score store '
+                        'instead of the cache')
+    parser.add_argument('--candidates', type=int, default=CANDIDATES)
+    parser.add_argument('--false-match-weight', type=float,
+                        default=FALSE_MATCH_WEIGHT)
+    parser.add_argument('--output', help='defaults to BANK.npz')
+    args = parser.parse_args()
+
+    bank = load_bank(args.bank)
+    keys = square_keys(bank)
+    positive_clips = read_clips(args.positives)
+    negative_clips = read_clips(args.negatives)
+    if args.store:
+        store = ScoreStore(args.store)
+        positives = best_scores_from_store(store, positive_clips, keys)
+        negatives = best_scores_from_store(store, negative_clips, keys)
+    else:
+        cache = ScoreCache(args.cache, None)
+        positives = best_scores_from_cache(cache, positive_clips, keys)
+        negatives = best_scores_from_cache(cache, negative_clips, keys)
+
+    missing = int(np.isnan(positives).all(axis=0).sum())
+    if missing:
+        logging.fatal('%d squares have no scores on any positive clip, run '
+                      'analyze.py first', missing)
+        return 1
+    if np.isnan(negatives).all():
+        logging.warning('No scores on any negative clip, the cutoffs fall '
+                        'back to the lowest score of the positive clips')
+
+    start = time.perf_counter()
+    candidates = np.linspace(0.0, 1.0, args.candidates)
+    result = calibrate(positives, negatives, candidates,
+                       args.false_match_weight)
+    elapsed = time.perf_counter() - start
+
+    print(f'{"square":>6} {"cutoff":>7} {"detect":>7} {"false":>7} '
+          f'{"loo det":>7} {"loo false":>9}')
+    for idx, square_number in enumerate(bank.square_numbers):
+        print(f'{int(square_number):>6} {result["cutoffs"][idx]:7.4f} '
+              f'{result["detection"][idx]:7.1%} '
+              f'{result["false_match"][idx]:7.1%} '
+              f'{result["loo_detection"][idx]:7.1%} '
+              f'{result["loo_false_match"][idx]:9.1%}')
+    print(f'Mean leave-one-clip-out detection rate '
+          f'{result["loo_detection"].mean():.1%}, false-match rate '
+          f'{result["loo_false_match"].mean():.1%}')
+    print(f'Searched {args.candidates} candidates for {len(keys)} squares '
+          f'over {len(positive_clips) + len(negative_clips)} clips in '
+          f'{elapsed * 1000:.1f} ms')
+
+    output = args.output or os.path.normpath(args.bank) + '.npz'
+    means = np.nanmean(positives, axis=0)
+    np.savez(output,
+             thresholds=np.array(list(zip(means, result['cutoffs']))),
+             mins=result['cutoffs'], raw_results=positives,
+             negative_results=negatives)
+    print(f'Saved {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
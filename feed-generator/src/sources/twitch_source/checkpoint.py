@@ -0,0 +1,173 @@
+"""
+Checkpoints of a scrutinize run.
+
+While scrutinize runs, a Checkpointer rewrites a JSON file every
+interval seconds with the running SSIM maxima of every bank, which
+squares have been found so far, the frame counts and the detector
+state. The file is replaced atomically, so it is always either the
+previous checkpoint or the new one, never half of each.
+
+The `results` entry has the same shape as what vedal987_scrutinize.py
+prints, so monitoring.sh can fall back to it when the run is cut short:
+
+    jq '.results' scrutinize_checkpoint.json > temp_result.json
+
+A restarted run can resume from the file: the maxima of every bank with
+the same streamer and content hash are merged into the new run, so
+squares found before the restart stay found (and retired). Only a
+checkpoint of the same stream is resumed: the stream identity (e.g. the
+Twitch stream id) is written in the checkpoint, and must match. Runs
+without one (e.g. local ones) only resume each other. Checkpoints older
+than max_age seconds are ignored either way, and so are banks without a
+content hash, which cannot be told apart.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+
+from batched_ssim import ReferenceBank
+
+CHECKPOINT_VERSION = 1
+DEFAULT_MAX_AGE = 3600.0  # seconds
+
+
+class Checkpointer:
+    """
+    Writes (and resumes from) the checkpoint file of a scrutinize run.
+    """
+    def __init__(self, path: str, streamers: list[str],
+                 interval: float = 30.0, resume: bool = True,
+                 max_age: float = DEFAULT_MAX_AGE,
+                 stream: Optional[str] = None) -> None:
+        self.path = path
+        self.stream = stream
+        self.streamers = streamers
+        self.interval = interval
+        self.should_resume = resume
+        self.max_age = max_age
+        self.last_write = time.monotonic()
+        self.content_hashes: list[Optional[str]] = [None] * len(streamers)
+        self.base_frames_read = 0
+        self.base_frames_evaluated = 0
+
+    def resume(self, banks: list[ReferenceBank]) -> list[Optional[np.ndarray]]:
+        """
+        Reads the previous checkpoint, if there is one and resuming
+        is on.
+
+        Args:
+            banks (list[ReferenceBank]): The banks of this run, in the
+                                         order of the streamers
+
+        Returns:
+            list[Optional[np.ndarray]]: The previous maxima of every
+                bank, or None for banks the checkpoint does not have (or
+                has for different reference squares)
+        """
+        self.content_hashes = [bank.content_hash for bank in banks]
+        previous: list[Optional[np.ndarray]] = [None] * len(banks)
+        if not self.should_resume:
+            return previous
+        try:
+            with open(self.path, encoding='utf8') as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return previous
+        except (OSError, ValueError):
+            logging.warning('Could not read checkpoint %s, starting over',
+                            self.path, exc_info=True)
+            return previous
+
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            logging.warning('Checkpoint %s has an unknown version, starting '
+                            'over', self.path)
+            return previous
+
+        if time.time() - checkpoint.get('updated_at', 0) > self.max_age:
+            logging.info('Checkpoint %s is too old to resume from, starting '
+                         'over', self.path)
+            return previous
+
+        if checkpoint.get('stream') != self.stream:
+            logging.info('Checkpoint %s is of another stream (%s), starting '
+                         'over', self.path, checkpoint.get('stream'))
+            return previous
+
+        for entry in checkpoint.get('banks', []):
+            for idx, (streamer, bank) in enumerate(zip(self.streamers,
+                                                       banks)):
+                if entry['streamer'] == streamer and \
+                   bank.content_hash is not None and \
+                   entry['content_hash'] == bank.content_hash and \
+                   len(entry['maxima']) == len(bank):
+                    previous[idx] = np.array(entry['maxima'],
+                                             dtype=np.float64)
+
+        self.base_frames_read = checkpoint.get('frames_read', 0)
+        self.base_frames_evaluated = checkpoint.get('frames_evaluated', 0)
+        logging.info('Resuming from checkpoint %s (%d frames read before): '
+                     '%s', self.path, self.base_frames_read,
+                     [streamer for streamer, maxima
+                      in zip(self.streamers, previous) if maxima is not None])
+        return previous
+
+    def due(self) -> bool:
+        """
+        Checks whether the next checkpoint should be written.
+
+        Returns:
+            bool: True once interval seconds passed since the last one
+        """
+        return time.monotonic() - self.last_write >= self.interval
+
+    def write(self, maxima: list[np.ndarray], found: list[list[bool]],
+              frames_read: int, frames_evaluated: int,
+              detector_found: Optional[list[bool]],
+              detector_lost_for: Optional[float],
+              complete: bool = False) -> None:
+        """
+        Atomically rewrites the checkpoint.
+
+        Args:
+            maxima (list[np.ndarray]): The running maxima of every bank
+            found (list[list[bool]]): Which squares have been found
+            frames_read (int): Frames read by this run
+            frames_evaluated (int): Frames evaluated by this run
+            detector_found (Optional[list[bool]]): Whether the detector
+                square matched each bank in the last frame
+            detector_lost_for (Optional[float]): How long the detector
+                square has been missing, in seconds of stream time
+            complete (bool): Whether the run finished
+        """
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'complete': complete,
+            'stream': self.stream,
+            'updated_at': time.time(),
+            'frames_read': self.base_frames_read + frames_read,
+            'frames_evaluated': self.base_frames_evaluated + frames_evaluated,
+            'detector': {'found': detector_found,
+                         'lost_for': detector_lost_for},
+            'banks': [{'streamer': streamer, 'content_hash': content_hash,
+                       'maxima': [float(score) for score in scores],
+                       'found': bank_found}
+                      for streamer, content_hash, scores, bank_found
+                      in zip(self.streamers, self.content_hashes, maxima,
+                             found)],
+            'results': [{'streamer': streamer,
+                         'result': json.dumps(bank_found)}
+                        for streamer, bank_found in zip(self.streamers,
+                                                        found)],
+        }
+
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, self.path)
+        self.last_write = time.monotonic()
+        logging.debug('Wrote checkpoint %s', self.path)
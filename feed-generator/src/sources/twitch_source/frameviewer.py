@@ -17,8 +17,8 @@ import numpy as np
 from PIL import Image
 
 from utils import (CROPPED_HEIGHT, CROPPED_WIDTH, EXPECTED_HEIGHT,
-                   EXPECTED_WIDTH, nparray_crop_frame,
-                   nparray_segment_into_squares, resize_image)
+                   EXPECTED_WIDTH, SquareGather, full_frame_layout,
+                   nparray_crop_frame, resize_image)
 
 SCALE = 5
 SCALED_WIDTH = EXPECTED_WIDTH * SCALE
@@ -64,14 +64,15 @@ class FrameNavigator:
             square_idx = int(self.square_input_box.text)
             frame = cv2.cvtColor(self.original_img, cv2.COLOR_BGR2RGB)
             frame = resize_image(frame, EXPECTED_HEIGHT, EXPECTED_WIDTH)
-            frame = nparray_crop_frame(frame, EXPECTED_HEIGHT, EXPECTED_WIDTH)
-            segments = nparray_segment_into_squares(frame, 20)
+            gather = SquareGather(np.array([square_idx]),
+                                  full_frame_layout(EXPECTED_WIDTH,
+                                                    EXPECTED_HEIGHT))
 
             file_idx = 0
             while os.path.exists(os.path.join(
                     self.out_dir, f'square_{square_idx}_{file_idx}.png')):
                 file_idx += 1
-            Image.fromarray(segments[square_idx]).save(
+            Image.fromarray(gather.gather(frame)[0]).save(
                 os.path.join(self.out_dir,
                              f'square_{square_idx}_{file_idx}.png'))
 
@@ -21,21 +21,22 @@ logging.basicConfig(level=logging.INFO)
 g: Optional[Github] = None
 
 
-async def on_online(_event: StreamOnlineEvent) -> None:
+async def on_online(event: StreamOnlineEvent) -> None:
     """
     Callback for an online stream.
 
     Args:
-        _event (StreamOnlineEvent): The event
+        event (StreamOnlineEvent): The event
     """
     assert g
 
     logging.info('Monitored stream online! Triggering workflow...')
+    # The stream id keeps checkpoints of this stream apart from others
     g.get_repo(
         'neuro-arg/arg-monitoring'
     ).get_workflow(
         'twitch-stream-trigger.yml'
-    ).create_dispatch(ref='main')
+    ).create_dispatch(ref='main', inputs={'stream_id': event.event.id})
     logging.info('Workflow triggered!')
 
 
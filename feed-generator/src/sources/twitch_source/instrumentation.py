@@ -0,0 +1,195 @@
+"""
+Low-overhead per-stage timers for the hot loops.
+
+A StageTimers keeps, per stage, a count, a total, a minimum, a maximum
+and a histogram of durations with one bucket per power of two
+nanoseconds. Recording a duration is a few integer operations on plain
+lists, so timing every stage of every frame costs well under a
+microsecond per frame. Percentiles are estimated from the histogram, by
+interpolating inside the bucket they fall in, and never fall outside
+the recorded minimum and maximum.
+
+When instrumentation is off, use NULL_TIMERS: it has the same methods,
+which do nothing.
+
+Usage:
+
+    tick = timers.now()
+    ...read a frame...
+    tick = timers.lap('read', tick)
+    ...score it...
+    tick = timers.lap('ssim', tick)
+"""
+
+import json
+import os
+import time
+from typing import Optional
+
+HISTOGRAM_BUCKETS = 64
+PERCENTILES = (50, 90, 99)
+
+
+class StageTimers:
+    """
+    Per-stage duration counters and histograms.
+    """
+    def __init__(self) -> None:
+        # stage -> [count, total_ns, max_ns, histogram, min_ns]
+        self.stages: dict[str, list] = {}
+
+    def now(self) -> int:
+        """
+        Gets the current time, to be passed to lap().
+
+        Returns:
+            int: A monotonic time in nanoseconds
+        """
+        return time.perf_counter_ns()
+
+    def lap(self, stage: str, start: int) -> int:
+        """
+        Records the time since start against a stage.
+
+        Args:
+            stage (str): The stage
+            start (int): The time the stage started, from now() or a
+                         previous lap()
+
+        Returns:
+            int: The current time, i.e. the start of the next stage
+        """
+        end = time.perf_counter_ns()
+        self.record(stage, end - start)
+        return end
+
+    def record(self, stage: str, duration_ns: int) -> None:
+        """
+        Records a duration against a stage.
+
+        Args:
+            stage (str): The stage
+            duration_ns (int): The duration, in nanoseconds
+        """
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = [0, 0, 0, [0] * HISTOGRAM_BUCKETS,
+                                          duration_ns]
+        stats[0] += 1
+        stats[1] += duration_ns
+        if duration_ns > stats[2]:
+            stats[2] = duration_ns
+        if duration_ns < stats[4]:
+            stats[4] = duration_ns
+        stats[3][min(duration_ns.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def take(self) -> dict[str, list]:
+        """
+        Gets the raw counters and resets them, e.g. to send them from a
+        worker process to the one that merge()s them.
+
+        Returns:
+            dict[str, list]: The raw counters
+        """
+        stages = self.stages
+        self.stages = {}
+        return stages
+
+    def merge(self, stages: dict[str, list]) -> None:
+        """
+        Adds raw counters from take() to these.
+
+        Args:
+            stages (dict[str, list]): The raw counters
+        """
+        for stage, (count, total, maximum, histogram, minimum) \
+                in stages.items():
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = [0, 0, 0,
+                                              [0] * HISTOGRAM_BUCKETS,
+                                              minimum]
+            stats[0] += count
+            stats[1] += total
+            stats[2] = max(stats[2], maximum)
+            stats[3] = [a + b for a, b in zip(stats[3], histogram)]
+            stats[4] = min(stats[4], minimum)
+
+    def summary(self) -> dict[str, dict]:
+        """
+        Summarizes every stage.
+
+        Returns:
+            dict[str, dict]: Per stage, the count, total and mean, the
+                             minimum and maximum, estimated
+                             percentiles and the
+                             non-empty histogram buckets (keyed by their
+                             upper bound in microseconds)
+        """
+        summary = {}
+        for stage, (count, total, maximum, histogram, minimum) \
+                in self.stages.items():
+            stage_summary = {'count': count,
+                             'total_ms': total / 1e6,
+                             'mean_us': total / count / 1e3 if count else 0.0,
+                             'min_us': minimum / 1e3,
+                             'max_us': maximum / 1e3}
+            for percentile in PERCENTILES:
+                stage_summary[f'p{percentile}_us'] = _histogram_percentile(
+                    histogram, count, minimum, maximum, percentile)
+            stage_summary['histogram_us'] = {
+                f'{(1 << bucket) / 1e3:g}': bucket_count
+                for bucket, bucket_count in enumerate(histogram)
+                if bucket_count}
+            summary[stage] = stage_summary
+        return summary
+
+    def dump(self, path: str, extra: Optional[dict] = None) -> None:
+        """
+        Writes the summary to a JSON file, atomically.
+
+        Args:
+            path (str): The file
+            extra (Optional[dict]): More top-level entries to write
+        """
+        content = dict(extra or {})
+        content['stages'] = self.summary()
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            json.dump(content, f, indent=2)
+        os.replace(temp_path, path)
+
+
+class NullTimers(StageTimers):
+    """
+    StageTimers that record nothing, for when instrumentation is off.
+    """
+    def now(self) -> int:
+        return 0
+
+    def lap(self, stage: str, start: int) -> int:
+        return 0
+
+    def record(self, stage: str, duration_ns: int) -> None:
+        pass
+
+
+NULL_TIMERS = NullTimers()
+
+
+def _histogram_percentile(histogram: list[int], count: int, minimum: int,
+                          maximum: int, percentile: float) -> float:
+    if not count:
+        return 0.0
+    rank = count * percentile / 100.0
+    seen = 0
+    for bucket, bucket_count in enumerate(histogram):
+        if bucket_count and seen + bucket_count >= rank:
+            # Bucket b holds [2 ** (b - 1), 2 ** b) ns, narrowed down to
+            # what was actually recorded
+            lower = max((1 << bucket) >> 1, minimum)
+            upper = min(1 << bucket, maximum)
+            fraction = (rank - seen) / bucket_count
+            return (lower + fraction * (upper - lower)) / 1e3
+        seen += bucket_count
+    return maximum / 1e3
@@ -5,6 +5,15 @@
 
 TEMP_RESULT_JSON="temp_result.json"
 TEMP_RESULT_WAV="for_pleep.wav"
+# vedal987_scrutinize.py rewrites this with its results so far every
+# SCRUTINIZE_CHECKPOINT_INTERVAL seconds, and resumes from it if restarted
+CHECKPOINT_JSON="scrutinize_checkpoint.json"
+export SCRUTINIZE_CHECKPOINT=$CHECKPOINT_JSON
+# The stream being watched (the workflow passes the Twitch stream id), so
+# that a checkpoint is never resumed into another stream
+export SCRUTINIZE_STREAM_ID=${SCRUTINIZE_STREAM_ID-}
+# Per-stage timings of the scrutinize loop. Set SCRUTINIZE_TIMINGS= to skip
+export SCRUTINIZE_TIMINGS=${SCRUTINIZE_TIMINGS-temp_result_timings.json}
 REQUIRED_PROGRAMS="streamlink ffmpeg python3 jq"
 REQUIRED_FILES="pleep-search out.bin"
 STREAM_TYPE="twitch"
@@ -37,7 +46,9 @@ case $MONITOR_SWITCH in
 esac
 
 
-trap quit_program INT
+# Ctrl-C, or a cancelled GitHub job (SIGINT first, then SIGTERM): write
+# what we have either way
+trap terminated INT TERM
 
 quit_program() {
     echo "Quitting..."
@@ -46,6 +57,43 @@ quit_program() {
     exit 0
 }
 
+write_results() {
+    # If scrutinize got cut short, its last checkpoint is all we have. Only
+    # trust a checkpoint written after this run started writing its results
+    if ! jq -e 'length > 0' $TEMP_RESULT_JSON > /dev/null 2>&1 && [ $CHECKPOINT_JSON -nt $TEMP_RESULT_JSON ]; then
+        echo "No final results, falling back to the last checkpoint"
+        jq '.results' $CHECKPOINT_JSON > $TEMP_RESULT_JSON
+    fi
+
+    AUDIO_JSON=$(RUST_LOG=info ./pleep-search --json out.bin $TEMP_RESULT_WAV | python3 audio_threshold_parser.py)
+
+    NEURO_JSON=$(jq '.[] | select(.streamer=="neuro")' $TEMP_RESULT_JSON)
+    EVIL_JSON=$(jq '.[] | select(.streamer=="evil")' $TEMP_RESULT_JSON)
+
+    if [ -z "$NEURO_JSON" ]; then
+        echo "Skipping Neuro result"
+    else
+        echo $(echo -n $NEURO_JSON | jq '.result') > $OUTPUT_NEURO_FILE
+        echo -n $AUDIO_JSON >> $OUTPUT_NEURO_FILE
+    fi
+
+    if [ -z "$EVIL_JSON" ]; then
+        echo "Skipping Evil result"
+    else
+        echo $(echo -n $EVIL_JSON | jq '.result') > $OUTPUT_EVIL_FILE
+        echo -n $AUDIO_JSON >> $OUTPUT_EVIL_FILE
+    fi
+}
+
+# Interrupted, cancelled or timed out: write what we have, but keep the
+# checkpoint so a restarted run can pick up where this one stopped
+terminated() {
+    trap - INT TERM
+    echo "Terminated, writing the results so far"
+    write_results
+    quit_program
+}
+
 for program in $REQUIRED_PROGRAMS; do
     if ! [ -x "$(command -v $program)" ];
     then
@@ -62,6 +110,14 @@ for file in $REQUIRED_FILES; do
     fi
 done
 
+# Compile the reference banks now, so that a broken bank fails here and
+# not after the stream has started
+if ! python3 reference_bank.py neuro neuro.npz evil evil.npz;
+then
+    echo "Error: could not compile the reference banks."
+    exit 1
+fi
+
 # NOTE: I couldn't think of another way to do this without it not
 # recognizing "Authorization=OAuth $TWITCH_OAUTH" as one argument
 if [ "$STREAM_TYPE" == "twitch" ]; then
@@ -84,23 +140,7 @@ if [ "$STREAM_TYPE" == "bilibili" ]; then
     fi
 fi
 
-AUDIO_JSON=$(RUST_LOG=info ./pleep-search --json out.bin $TEMP_RESULT_WAV | python3 audio_threshold_parser.py)
-
-NEURO_JSON=$(jq '.[] | select(.streamer=="neuro")' $TEMP_RESULT_JSON)
-EVIL_JSON=$(jq '.[] | select(.streamer=="evil")' $TEMP_RESULT_JSON)
-
-if [ -z "$NEURO_JSON" ]; then
-    echo "Skipping Neuro result"
-else
-    echo $(echo -n $NEURO_JSON | jq '.result') > $OUTPUT_NEURO_FILE
-    echo -n $AUDIO_JSON >> $OUTPUT_NEURO_FILE
-fi
-
-if [ -z "$EVIL_JSON" ]; then
-    echo "Skipping Evil result"
-else
-    echo $(echo -n $EVIL_JSON | jq '.result') > $OUTPUT_EVIL_FILE
-    echo -n $AUDIO_JSON >> $OUTPUT_EVIL_FILE
-fi
+write_results
+rm -f $CHECKPOINT_JSON
 
 quit_program
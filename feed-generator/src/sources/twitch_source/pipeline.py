@@ -0,0 +1,170 @@
+"""
+Shared-memory frame pipeline for scrutinize.
+
+The process reading the ffmpeg pipe reads every frame straight into a
+slot of a multiprocessing.shared_memory ring. Scorer workers take
+whichever frame comes next, gather and brightness-adjust its squares
+and run the batched SSIM on them, then hand back only the per-bank
+scores. Frame pixels never go through a pickle: a task is a slot
+number, and a result is a few dozen floats per bank.
+
+The reader process stays the reducer. It merges the scores into the
+running maxima as results come back, so the outcome is the same as
+scoring the same frames serially.
+"""
+
+import logging
+import multiprocessing
+import queue
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from batched_ssim import FrameScorer
+
+RESULT_POLL_INTERVAL = 1.0  # seconds between checks for dead workers
+
+
+class SharedFrameRing:
+    """
+    A ring of frames in shared memory.
+    """
+    def __init__(self, slots: int, height: int, width: int,
+                 name: Optional[str] = None) -> None:
+        size = slots * height * width * 3
+        self.owner = name is None
+        self.shm = SharedMemory(name=name, create=self.owner, size=size)
+        self.frames: np.ndarray = np.ndarray((slots, height, width, 3),
+                                             dtype=np.uint8,
+                                             buffer=self.shm.buf)
+
+    def close(self) -> None:
+        """
+        Detaches from the ring, and frees it if this process created it.
+        """
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _score_worker(ring_name: str, shape: tuple[int, int, int],
+                  scorer: FrameScorer, tasks: Any, results: Any) -> None:
+    ring = SharedFrameRing(*shape, name=ring_name)
+    try:
+        while (task := tasks.get()) is not None:
+            slot, frame_idx, active = task
+            scores = scorer.score(ring.frames[slot], active)
+            results.put((slot, frame_idx, scores,
+                         scorer.take_counts(), scorer.timers.take()))
+    finally:
+        ring.close()
+
+
+class ScoringPipeline:
+    """
+    Hands frames to a pool of scorer workers through a SharedFrameRing.
+
+    Usage: take a buffer with next_slot(), read a frame into it, then
+    either submit() it or release() it unscored. Every result is passed
+    to on_result(frame_idx, scores) in the calling process, in whatever
+    order the workers finish.
+    """
+    def __init__(self, scorer: FrameScorer, height: int, width: int,
+                 workers: int,
+                 on_result: Callable[[int, list[np.ndarray]], None]) -> None:
+        context = multiprocessing.get_context()
+        slots = 2 * workers + 1
+        self.ring = SharedFrameRing(slots, height, width)
+        self.free_slots = deque(range(slots))
+        self.scorer = scorer
+        self.on_result = on_result
+        self.in_flight = 0
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(
+                target=_score_worker,
+                args=(self.ring.shm.name, (slots, height, width), scorer,
+                      self.tasks, self.results),
+                daemon=True)
+            for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        logging.info('Started %d scorer workers over %d shared frame slots',
+                     workers, slots)
+
+    def _collect(self, block: bool) -> bool:
+        while True:
+            try:
+                slot, frame_idx, scores, counts, timings = self.results.get(
+                    timeout=RESULT_POLL_INTERVAL) if block \
+                    else self.results.get_nowait()
+                break
+            except queue.Empty:
+                if not block:
+                    return False
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError('A scorer worker died')
+
+        self.free_slots.append(slot)
+        self.in_flight -= 1
+        self.scorer.counts += counts
+        self.scorer.timers.merge(timings)
+        self.on_result(frame_idx, scores)
+        return True
+
+    def next_slot(self) -> tuple[int, np.ndarray]:
+        """
+        Gets a free slot, waiting for a worker to finish one if needed.
+
+        Returns:
+            tuple[int, np.ndarray]: The slot and its frame buffer
+        """
+        while self._collect(block=not self.free_slots):
+            pass
+        slot = self.free_slots.popleft()
+        return slot, self.ring.frames[slot]
+
+    def submit(self, slot: int, frame_idx: int,
+               active: Optional[list[np.ndarray]] = None) -> None:
+        """
+        Queues the frame in a slot for scoring.
+
+        Args:
+            slot (int): The slot
+            frame_idx (int): The frame index, handed back to on_result
+            active (Optional[list[np.ndarray]]): Which references to
+                                                 score, see
+                                                 FrameScorer.score
+        """
+        self.in_flight += 1
+        self.tasks.put((slot, frame_idx, active))
+
+    def release(self, slot: int) -> None:
+        """
+        Gives a slot back without scoring it.
+
+        Args:
+            slot (int): The slot
+        """
+        self.free_slots.appendleft(slot)
+
+    def close(self) -> None:
+        """
+        Waits for every queued frame, then stops the workers and frees
+        the ring.
+        """
+        try:
+            while self.in_flight:
+                self._collect(block=True)
+        finally:
+            for _ in self.workers:
+                self.tasks.put(None)
+            for worker in self.workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+            self.ring.close()
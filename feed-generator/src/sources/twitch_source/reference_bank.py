@@ -0,0 +1,255 @@
+"""
+Compiled reference-bank format.
+
+A bank directory (`neuro/`, `evil/`) and its thresholds file
+(`neuro.npz`, `evil.npz`) are compiled into one contiguous file that
+holds the square indices, the uint8 pixels, the precomputed SSIM
+moments of every reference and the (mean, min) thresholds. Loading it
+is a memory map plus a few array views: no PNG is decoded.
+
+The file starts with a magic string and a JSON header describing every
+array (dtype, shape, offset), followed by the arrays themselves,
+aligned to ALIGNMENT bytes. The header also stores a content hash of
+the PNGs and the thresholds file it was built from, so load_bank()
+rebuilds a stale artifact on its own.
+
+Run this script to build the artifacts ahead of time, e.g. before a
+stream starts:
+
+    python3 reference_bank.py neuro neuro.npz evil evil.npz
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from batched_ssim import ReferenceBank, ssim_moments
+from utils import IMAGES_FILENAME_PATTERN
+
+MAGIC = b'ARGBANK\x01'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+ARRAY_FIELDS = ('square_numbers', 'pixels', 'mean', 'variance', 'thresholds')
+
+
+def default_artifact_path(directory: str,
+                          thresholds_file: Optional[str]) -> str:
+    """
+    Gets where the artifact of a bank lives by default: next to the
+    thresholds file (`neuro.npz` -> `neuro.bank`), or next to the
+    directory if the bank has no thresholds yet.
+
+    Args:
+        directory (str): The bank directory
+        thresholds_file (Optional[str]): The thresholds file
+
+    Returns:
+        str: The artifact path
+    """
+    if thresholds_file is not None:
+        return os.path.splitext(thresholds_file)[0] + '.bank'
+    return os.path.normpath(directory) + '.images.bank'
+
+
+def _list_sources(directory: str) -> list[tuple[str, int]]:
+    sources = []
+    for file in sorted(os.listdir(directory)):
+        matches = re.match(IMAGES_FILENAME_PATTERN, file)
+        if not matches:
+            logging.debug('The file %s does not match the pattern. Skipping.',
+                          file)
+            continue
+        sources.append((file, int(matches.group(1))))
+    return sources
+
+
+def content_hash(directory: str, thresholds_file: Optional[str]) -> str:
+    """
+    Hashes everything an artifact is built from. This reads the raw
+    bytes of every source, but does not decode anything.
+
+    Args:
+        directory (str): The bank directory
+        thresholds_file (Optional[str]): The thresholds file
+
+    Returns:
+        str: The hex digest
+    """
+    sha = hashlib.sha256()
+    sha.update(f'{FORMAT_VERSION}\n'.encode('ascii'))
+    for file, _square_idx in _list_sources(directory):
+        with open(os.path.join(directory, file), 'rb') as f:
+            data = f.read()
+        sha.update(f'{file}\n{len(data)}\n'.encode('utf-8'))
+        sha.update(data)
+
+    if thresholds_file is not None:
+        with open(thresholds_file, 'rb') as f:
+            sha.update(f.read())
+
+    return sha.hexdigest()
+
+
+def compile_bank(directory: str, thresholds_file: Optional[str],
+                 artifact_path: str) -> ReferenceBank:
+    """
+    Decodes a bank directory, computes its SSIM moments and writes the
+    artifact atomically.
+
+    Args:
+        directory (str): The bank directory
+        thresholds_file (Optional[str]): The thresholds file, if any
+        artifact_path (str): Where to write the artifact
+
+    Returns:
+        ReferenceBank: The compiled bank
+
+    Throws:
+        ValueError: If the number of images and thresholds differ
+    """
+    digest = content_hash(directory, thresholds_file)
+    sources = _list_sources(directory)
+    if not sources:
+        raise ValueError(f'No reference squares found in {directory}')
+
+    pixels = np.stack([
+        np.array(Image.open(os.path.join(directory, file)))
+        for file, _square_idx in sources]).astype(np.uint8)
+    square_numbers = np.array([square_idx for _file, square_idx in sources],
+                              dtype=np.int64)
+    mean, variance = ssim_moments(pixels)
+
+    arrays = {'square_numbers': square_numbers, 'pixels': pixels,
+              'mean': mean, 'variance': variance}
+    if thresholds_file is not None:
+        with np.load(thresholds_file) as handle:
+            thresholds = np.asarray(handle['thresholds'], dtype=np.float64)
+        if len(thresholds) != len(pixels):
+            raise ValueError(
+                f'Mismatch between images ({len(pixels)}) in {directory} '
+                f'and thresholds ({len(thresholds)}) in {thresholds_file}')
+        arrays['thresholds'] = thresholds
+
+    header: dict = {'version': FORMAT_VERSION, 'content_hash': digest,
+                    'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str,
+                                  'shape': list(array.shape),
+                                  'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header_bytes = json.dumps(header).encode('ascii')
+    data_start = len(MAGIC) + 8 + len(header_bytes)
+    data_start = -(-data_start // ALIGNMENT) * ALIGNMENT
+
+    temp_path = f'{artifact_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(temp_path, artifact_path)
+
+    logging.info('Compiled %d reference squares from %s into %s',
+                 len(pixels), directory, artifact_path)
+    return open_artifact(artifact_path)
+
+
+def open_artifact(artifact_path: str) -> ReferenceBank:
+    """
+    Memory maps an artifact. The arrays of the returned bank are
+    read-only views into the file.
+
+    Args:
+        artifact_path (str): The artifact
+
+    Returns:
+        ReferenceBank: The bank
+
+    Throws:
+        ValueError: If the file is not a bank artifact of this version
+    """
+    with open(artifact_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{artifact_path} is not a bank artifact')
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length))
+
+    if header.get('version') != FORMAT_VERSION:
+        raise ValueError(f'{artifact_path} has an unknown version')
+
+    data_start = len(MAGIC) + 8 + header_length
+    data_start = -(-data_start // ALIGNMENT) * ALIGNMENT
+    mapped = np.memmap(artifact_path, dtype=np.uint8, mode='r')
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        start = data_start + spec['offset']
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = mapped[start:start + count * dtype.itemsize] \
+            .view(dtype).reshape(spec['shape'])
+
+    return ReferenceBank(arrays['square_numbers'].astype(np.intp),
+                         arrays['pixels'], arrays['mean'],
+                         arrays['variance'], arrays.get('thresholds'),
+                         header['content_hash'])
+
+
+def load_bank(directory: str, thresholds_file: Optional[str] = None,
+              artifact_path: Optional[str] = None) -> ReferenceBank:
+    """
+    Loads a bank from its artifact, (re)building the artifact first if
+    it is missing or was built from different sources.
+
+    Args:
+        directory (str): The bank directory
+        thresholds_file (Optional[str]): The thresholds file, if any
+        artifact_path (Optional[str]): The artifact. Defaults to
+                                       default_artifact_path()
+
+    Returns:
+        ReferenceBank: The bank
+
+    Throws:
+        ValueError: If the number of images and thresholds differ
+    """
+    if artifact_path is None:
+        artifact_path = default_artifact_path(directory, thresholds_file)
+
+    digest = content_hash(directory, thresholds_file)
+    try:
+        bank = open_artifact(artifact_path)
+        if bank.content_hash == digest:
+            return bank
+        logging.info('%s is stale, rebuilding', artifact_path)
+    except (OSError, ValueError, KeyError):
+        logging.info('%s is missing or unreadable, building', artifact_path)
+
+    return compile_bank(directory, thresholds_file, artifact_path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 3 or len(sys.argv) % 2 == 0:
+        print(f'Usage: {sys.argv[0]} DIRECTORY THRESHOLDS_FILE '
+              '[DIRECTORY THRESHOLDS_FILE ...]')
+        sys.exit(1)
+
+    for bank_dir, bank_thresholds in zip(sys.argv[1::2], sys.argv[2::2]):
+        try:
+            load_bank(bank_dir, bank_thresholds)
+        except ValueError as e:
+            logging.fatal('%s', e)
+            sys.exit(1)
@@ -0,0 +1,159 @@
+"""
+Persistent cache of the per-clip scores of analyze.py.
+
+For every training clip, the cache holds the best SSIM score of every
+reference square over the clip. A square is keyed by a hash of its
+square number and pixels, so adding, removing or editing one PNG only
+invalidates that square. The scores of a clip are kept per fingerprint
+of the settings that change scores (detection square, thresholds, ...),
+so runs with other settings never reuse them, but do not evict them
+either: e.g. the neuro and evil runs of analyze.py share one file.
+
+analyze.py then only downloads the clips that miss at least one square,
+only scores the missing squares, and rebuilds results.npz from the
+cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+
+from batched_ssim import ReferenceBank
+
+CACHE_VERSION = 2
+# Part of every fingerprint: bump it when scores are computed differently
+SCORES_VERSION = 1
+
+
+def square_keys(bank: ReferenceBank) -> list[str]:
+    """
+    Gets the cache key of every reference square of a bank.
+
+    Args:
+        bank (ReferenceBank): The bank
+
+    Returns:
+        list[str]: The key of every square, in bank order
+    """
+    keys = []
+    for square_number, pixels in zip(bank.square_numbers, bank.pixels):
+        sha = hashlib.sha256(f'{int(square_number)}\n'.encode('ascii'))
+        sha.update(np.ascontiguousarray(pixels).tobytes())
+        keys.append(sha.hexdigest())
+    return keys
+
+
+def settings_fingerprint(**settings) -> str:
+    """
+    Hashes the settings that change scores.
+
+    Args:
+        **settings: The settings. Values must be JSON-serializable, or
+                    bytes (hashed as is)
+
+    Returns:
+        str: The hex digest
+    """
+    sha = hashlib.sha256(f'{SCORES_VERSION}\n'.encode('ascii'))
+    for name, value in sorted(settings.items()):
+        sha.update(f'{name}\n'.encode('utf-8'))
+        if isinstance(value, bytes):
+            sha.update(value)
+        else:
+            sha.update(json.dumps(value).encode('utf-8'))
+        sha.update(b'\n')
+    return sha.hexdigest()
+
+
+class ScoreCache:
+    """
+    The scores of every (clip, reference square) pair computed so far.
+    """
+    def __init__(self, path: str, fingerprint: Optional[str]) -> None:
+        """
+        Loads the cache, if it exists.
+
+        Args:
+            path (str): The cache file
+            fingerprint (Optional[str]): The settings fingerprint. Only
+                the scores of this fingerprint are looked up. None looks
+                up the scores of the settings each clip was last scored
+                with, e.g. to only read the cache
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        # clip -> fingerprint (least recently stored first) -> square
+        # key -> score
+        self.clips: dict[str, dict[str, dict[str, float]]] = {}
+        try:
+            with open(path, encoding='utf8') as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.warning('Could not read score cache %s, starting over',
+                            path, exc_info=True)
+            return
+
+        if cache.get('version') == 1:
+            # One fingerprint per clip
+            self.clips = {clip: {entry['fingerprint']: entry['scores']}
+                          for clip, entry in cache.get('clips', {}).items()}
+        elif cache.get('version') == CACHE_VERSION:
+            self.clips = cache.get('clips', {})
+        else:
+            logging.info('Score cache %s has an unknown version, starting '
+                         'over', path)
+
+    def lookup(self, clip: str, keys: list[str]) -> np.ndarray:
+        """
+        Gets the cached scores of a clip.
+
+        Args:
+            clip (str): The clip
+            keys (list[str]): The keys of the squares, see square_keys()
+
+        Returns:
+            np.ndarray: The score of every square, NaN where missing
+        """
+        fingerprints = self.clips.get(clip, {})
+        if self.fingerprint is not None:
+            scores = fingerprints.get(self.fingerprint, {})
+        else:
+            scores = list(fingerprints.values())[-1] if fingerprints else {}
+        return np.array([scores.get(key, np.nan) for key in keys],
+                        dtype=np.float64)
+
+    def store(self, clip: str, keys: list[str], scores: np.ndarray,
+              mask: np.ndarray) -> None:
+        """
+        Adds scores of a clip to the cache.
+
+        Args:
+            clip (str): The clip
+            keys (list[str]): The keys of the squares, see square_keys()
+            scores (np.ndarray): The score of every square
+            mask (np.ndarray): Which of the scores to store
+        """
+        assert self.fingerprint is not None
+        fingerprints = self.clips.setdefault(clip, {})
+        # Move the fingerprint last, as the one the clip was last scored
+        # with
+        entry = fingerprints.pop(self.fingerprint, {})
+        fingerprints[self.fingerprint] = entry
+        for key, score in zip(np.asarray(keys)[mask], scores[mask]):
+            entry[str(key)] = float(score)
+
+    def save(self) -> None:
+        """
+        Atomically rewrites the cache file.
+        """
+        cache = {'version': CACHE_VERSION, 'clips': self.clips}
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,369 @@
+"""
+Frame-level store of the scores of analyze.py.
+
+analyze.py only keeps the best score of every square over a clip. With
+a store (ANALYZE_STORE), it also appends the score of every square in
+every frame to one directory per clip and scoring run, i.e. per clip,
+settings fingerprint and set of squares:
+
+    <store>/<hash of the clip URL>/<hash of the fingerprint and keys>/
+        meta.json       the clip, the square keys, dtype, fps, ...
+        scores.bin      (frames, squares) scores, appended row by row
+        timestamps.bin  float64 timestamp of every frame, in seconds
+
+so scoring a clip against the other bank, or with the other detection
+square, does not overwrite what it was scored with before.
+
+Both .bin files are append-only, and are read back as memory maps, so
+calibration scripts can compute percentiles, times to first match or
+any other aggregation over every clip without decoding a video again
+and without loading everything into RAM:
+
+    store = ScoreStore('score_store')
+    for clip in store.clips():
+        columns = clip.columns(square_keys(bank))
+        ...clip.scores[:, columns]...
+
+Squares are identified by the same keys as the score cache (see
+score_cache.square_keys), so a store stays usable after squares are
+added or removed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+from typing import Optional
+
+import numpy as np
+
+STORE_VERSION = 1
+DEFAULT_DTYPE = 'float16'
+CHUNK_FRAMES = 256
+
+
+def _write_json(path: str, content: dict) -> None:
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf8') as f:
+        json.dump(content, f)
+    os.replace(temp_path, path)
+
+
+def _map(path: str, dtype: np.dtype, rows: int,
+         row_shape: tuple[int, ...]) -> np.ndarray:
+    if rows == 0:
+        return np.empty((0, *row_shape), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(rows, *row_shape))
+
+
+class ClipScoreWriter:
+    """
+    Appends the scores of one clip to its directory, a chunk of frames
+    at a time. Starting a writer discards whatever the directory held,
+    i.e. an earlier run with the same settings and squares.
+    """
+    def __init__(self, directory: str, clip: str, keys: list[str],
+                 fingerprint: str, fps: Optional[float],
+                 dtype: str = DEFAULT_DTYPE) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.meta = {'version': STORE_VERSION, 'clip': clip, 'keys': keys,
+                     'fingerprint': fingerprint, 'fps': fps, 'dtype': dtype,
+                     'frames': 0, 'complete': False}
+        self.scores = np.empty((CHUNK_FRAMES, len(keys)), dtype=dtype)
+        self.timestamps = np.empty(CHUNK_FRAMES, dtype=np.float64)
+        self.buffered = 0
+        # Invalidate the old meta first, so a reader never pairs it with
+        # the new (shorter) data
+        _write_json(os.path.join(directory, 'meta.json'), self.meta)
+        self.scores_file = open(os.path.join(directory, 'scores.bin'), 'wb')
+        self.timestamps_file = open(os.path.join(directory, 'timestamps.bin'),
+                                    'wb')
+
+    def append(self, timestamp: float, scores: np.ndarray) -> None:
+        """
+        Appends the scores of one frame.
+
+        Args:
+            timestamp (float): The timestamp of the frame, in seconds
+            scores (np.ndarray): The score of every square, in the order
+                                 of the keys
+        """
+        self.scores[self.buffered] = scores
+        self.timestamps[self.buffered] = timestamp
+        self.buffered += 1
+        if self.buffered == CHUNK_FRAMES:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered frames out.
+        """
+        self.scores_file.write(self.scores[:self.buffered].tobytes())
+        self.timestamps_file.write(self.timestamps[:self.buffered].tobytes())
+        self.scores_file.flush()
+        self.timestamps_file.flush()
+        self.meta['frames'] += self.buffered
+        self.buffered = 0
+
+    def close(self, complete: bool = True) -> None:
+        """
+        Writes the buffered frames out and closes the files.
+
+        Args:
+            complete (bool): Whether the whole clip was scored
+        """
+        self.flush()
+        self.scores_file.close()
+        self.timestamps_file.close()
+        self.meta['complete'] = complete
+        _write_json(os.path.join(self.directory, 'meta.json'), self.meta)
+
+
+class ClipScores:
+    """
+    The stored scores of one clip, memory mapped.
+
+    Attributes:
+        clip (str): The clip
+        keys (list[str]): The key of every square (column)
+        fingerprint (str): The settings the clip was scored with
+        fps (Optional[float]): The frame rate the clip was decoded at
+        complete (bool): Whether the whole clip was scored
+        scores (np.ndarray): (frames, squares) scores
+        timestamps (np.ndarray): The timestamp of every frame, in seconds
+    """
+    def __init__(self, directory: str) -> None:
+        with open(os.path.join(directory, 'meta.json'), encoding='utf8') as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError(f'{directory} has an unknown version')
+
+        self.clip: str = meta['clip']
+        self.keys: list[str] = meta['keys']
+        self.fingerprint: str = meta['fingerprint']
+        self.fps: Optional[float] = meta['fps']
+        self.complete: bool = meta['complete']
+
+        # A writer that is still running (or was killed) may be ahead of
+        # the meta: map whatever whole frames both files have
+        dtype = np.dtype(meta['dtype'])
+        scores_path = os.path.join(directory, 'scores.bin')
+        timestamps_path = os.path.join(directory, 'timestamps.bin')
+        row_bytes = dtype.itemsize * len(self.keys)
+        frames = min(os.path.getsize(scores_path) // row_bytes
+                     if row_bytes else 0,
+                     os.path.getsize(timestamps_path) // 8)
+        self.scores = _map(scores_path, dtype, frames, (len(self.keys),))
+        self.timestamps = _map(timestamps_path, np.dtype(np.float64), frames,
+                               ())
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def columns(self, keys: list[str]) -> np.ndarray:
+        """
+        Finds squares in the stored columns.
+
+        Args:
+            keys (list[str]): The keys of the squares
+
+        Returns:
+            np.ndarray: The column of every square, -1 where missing
+        """
+        index = {key: column for column, key in enumerate(self.keys)}
+        return np.array([index.get(key, -1) for key in keys], dtype=np.intp)
+
+
+class ScoreStore:
+    """
+    A directory of ClipScores, one per clip.
+    """
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def clip_directory(self, clip: str) -> str:
+        """
+        Gets the directory of a clip, which holds one directory per
+        scoring run.
+
+        Args:
+            clip (str): The clip
+
+        Returns:
+            str: The directory
+        """
+        digest = hashlib.sha256(clip.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.root, digest)
+
+    def run_directory(self, clip: str, keys: list[str],
+                      fingerprint: str) -> str:
+        """
+        Gets the directory of a scoring run of a clip.
+
+        Args:
+            clip (str): The clip
+            keys (list[str]): The key of every square
+            fingerprint (str): The settings the clip is scored with
+
+        Returns:
+            str: The directory
+        """
+        digest = hashlib.sha256(
+            '\n'.join([fingerprint, *keys]).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.clip_directory(clip), digest)
+
+    def writer(self, clip: str, keys: list[str], fingerprint: str,
+               fps: Optional[float],
+               dtype: str = DEFAULT_DTYPE) -> ClipScoreWriter:
+        """
+        Starts (over) the scores of a clip with these settings and
+        squares.
+
+        Args:
+            clip (str): The clip
+            keys (list[str]): The key of every square
+            fingerprint (str): The settings the clip is scored with
+            fps (Optional[float]): The frame rate the clip is decoded at
+            dtype (str): The dtype of the scores
+
+        Returns:
+            ClipScoreWriter: The writer
+        """
+        return ClipScoreWriter(self.run_directory(clip, keys, fingerprint),
+                               clip, keys, fingerprint, fps, dtype)
+
+    def runs(self, clip: str) -> list[ClipScores]:
+        """
+        Opens every scoring run of a clip.
+
+        Args:
+            clip (str): The clip
+
+        Returns:
+            list[ClipScores]: The runs, least recently written first
+        """
+        directory = self.clip_directory(clip)
+        if not os.path.isdir(directory):
+            return []
+        runs = []
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            if not os.path.isdir(path):
+                continue
+            try:
+                runs.append((os.path.getmtime(os.path.join(path,
+                                                           'meta.json')),
+                             ClipScores(path)))
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError):
+                logging.warning('Could not read the stored scores of %s in '
+                                '%s', clip, path, exc_info=True)
+        return [scores for _, scores in sorted(runs, key=lambda run: run[0])]
+
+    def open(self, clip: str, keys: Optional[list[str]] = None,
+             fingerprint: Optional[str] = None) -> Optional[ClipScores]:
+        """
+        Opens the scores of a clip, from the run that best matches: the
+        one with this fingerprint (if given) that has the most of these
+        squares (if given), complete runs first, then the latest.
+
+        Args:
+            clip (str): The clip
+            keys (Optional[list[str]]): The keys of the squares needed
+            fingerprint (Optional[str]): The settings needed
+
+        Returns:
+            Optional[ClipScores]: The scores, or None if there are none
+        """
+        runs = [scores for scores in self.runs(clip)
+                if fingerprint is None or scores.fingerprint == fingerprint]
+        if keys is not None:
+            runs = [scores for scores in runs
+                    if (scores.columns(keys) >= 0).any()]
+        if not runs:
+            return None
+        # max() keeps the first of equals, so go from the latest
+        return max(reversed(runs), key=lambda scores: (
+            int((scores.columns(keys) >= 0).sum()) if keys is not None
+            else 0, scores.complete))
+
+    def has(self, clip: str, keys: list[str], fingerprint: str) -> bool:
+        """
+        Checks whether a clip was completely scored, for every square,
+        with these settings.
+
+        Args:
+            clip (str): The clip
+            keys (list[str]): The keys of the squares
+            fingerprint (str): The settings
+
+        Returns:
+            bool: True if nothing needs to be scored again
+        """
+        scores = self.open(clip, keys, fingerprint)
+        return scores is not None and scores.complete \
+            and bool((scores.columns(keys) >= 0).all())
+
+    def clips(self) -> list[ClipScores]:
+        """
+        Opens every scoring run of every clip of the store.
+
+        Returns:
+            list[ClipScores]: The runs
+        """
+        if not os.path.isdir(self.root):
+            return []
+        clips = []
+        for entry in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, entry)
+            if not os.path.isdir(directory):
+                continue
+            for run in sorted(os.listdir(directory)):
+                try:
+                    clips.append(ClipScores(os.path.join(directory, run)))
+                except (OSError, ValueError, KeyError):
+                    logging.debug('Skipping %s/%s', entry, run)
+        return clips
+
+
+def first_match_times(scores: np.ndarray, timestamps: np.ndarray,
+                      cutoffs: np.ndarray) -> np.ndarray:
+    """
+    Finds when every square first reached its cutoff.
+
+    Args:
+        scores (np.ndarray): (frames, squares) scores
+        timestamps (np.ndarray): The timestamp of every frame
+        cutoffs (np.ndarray): The cutoff of every square
+
+    Returns:
+        np.ndarray: The first timestamp at which every square reached
+                    its cutoff, NaN for squares that never did
+    """
+    reached = np.asarray(scores) >= cutoffs
+    first = reached.argmax(axis=0)
+    times = np.asarray(timestamps, dtype=np.float64)[first] \
+        if len(timestamps) else np.zeros(len(cutoffs))
+    return np.where(reached.any(axis=0), times, np.nan)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(f'Usage: {sys.argv[0]} STORE')
+        sys.exit(1)
+
+    for clip_scores in ScoreStore(sys.argv[1]).clips():
+        duration = clip_scores.timestamps[-1] if len(clip_scores) else 0.0
+        best = clip_scores.scores.max(axis=0) if len(clip_scores) \
+            else np.zeros(0)
+        print(f'{clip_scores.clip}: {len(clip_scores)} frames, '
+              f'{duration:.1f}s, {len(clip_scores.keys)} squares'
+              f'{"" if clip_scores.complete else " (incomplete)"}')
+        if len(best):
+            print(f'    best score p10/p50/p90: '
+                  f'{np.percentile(best, 10):.3f}/'
+                  f'{np.percentile(best, 50):.3f}/'
+                  f'{np.percentile(best, 90):.3f}')
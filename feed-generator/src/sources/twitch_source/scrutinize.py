@@ -15,27 +15,28 @@ import os
 import re
 import subprocess
 import time
-from collections import namedtuple
-from io import BytesIO
-from typing import cast
+from collections import deque
+from dataclasses import dataclass
+from typing import BinaryIO, Optional, cast
 
 import numpy as np
 from PIL import Image
 
-from utils import (DETECTOR_THRESHOLD, EXPECTED_HEIGHT, EXPECTED_WIDTH,
-                   WHOSE_STREAM_SQUARE_NUMBER, calculate_rgb_diff,
-                   calculate_ssim, create_process_for_720p_video_for_youtube,
-                   nparray_crop_frame, nparray_segment_into_squares,
-                   ppm_header_parser, whose_stream,
-                   extract_dynamic_detector_square)
-
-# Tuples
-# TODO: put into utilities
-SourceImageTuple = namedtuple('SourceImageTuple',
-                              ['array', 'square_number'])
+from batched_ssim import COUNT_FIELDS, FrameScorer, ReferenceBank
+from checkpoint import Checkpointer
+from instrumentation import NULL_TIMERS, StageTimers
+from pipeline import ScoringPipeline
+from reference_bank import load_bank
+from utils import (DETECTOR_THRESHOLD, IMAGES_FILENAME_PATTERN,
+                   ROI_LAYOUT, WHOSE_STREAM_SQUARE_NUMBER, FrameLayout,
+                   PPMFrameReader, RawFrameReader, SourceImageTuple,
+                   brightness_lut,
+                   calculate_rgb_diff, calculate_ssim,
+                   create_process_for_720p_video_for_youtube,
+                   full_frame_layout, whose_stream)
+
 DEPTH = 3  # hardcoded for speed
 SQUARE_SIZE = 20
-IMAGES_FILENAME_PATTERN = r'square_(\d+)_(\d+).png'
 
 
 def process_squares_with_target_image(
@@ -58,7 +59,8 @@ def process_squares_with_target_image(
 
 def load_images_from_directory(dirname: str) -> list[SourceImageTuple]:
     """
-    Load images from a directory.
+    Load images from a directory. Prefer reference_bank.load_bank(),
+    which does not decode the images on every run.
 
     Args:
         dirname (str): The directory name
@@ -92,20 +94,45 @@ def load_thresholds(filename: str) -> np.ndarray:
     Returns:
         np.ndarray: A numpy array
     """
-    thresholds_handle = np.load(filename, mmap_mode='r')
-    thresholds = thresholds_handle['thresholds']
-    thresholds_handle.close()
-    return thresholds
+    with np.load(filename) as thresholds_handle:
+        return thresholds_handle['thresholds']
+
+
+def create_frame_reader(process: subprocess.Popen,
+                        layout: Optional[FrameLayout] = None,
+                        ring_size: int = 2) -> RawFrameReader:
+    """
+    Creates a frame reader over the stdout of a process.
+
+    Args:
+        process (subprocess.Popen): The process
+        layout (Optional[FrameLayout]): If given, the process outputs
+                                        rawvideo frames in this layout.
+                                        Otherwise, PPM frames
+        ring_size (int): The number of frame buffers to cycle through
+
+    Returns:
+        RawFrameReader: The reader
+    """
+    stream = cast(BinaryIO, process.stdout)
+    if layout is None:
+        return PPMFrameReader(stream, ring_size)
+    return RawFrameReader(stream, layout.width, layout.height, ring_size)
 
 
 def read_one_frame(
         process: subprocess.Popen,
+        layout: Optional[FrameLayout] = None,
 ) -> tuple[np.array, int, int]:
     """
-    Reads one frame from a process.
+    Reads one frame from a process. The returned array is owned by the
+    caller; use a frame reader to read many frames without allocating.
 
     Args:
         process (subprocess.Popen): The process
+        layout (Optional[FrameLayout]): If given, the process outputs
+                                        rawvideo frames in this layout.
+                                        Otherwise, PPM frames
 
     Returns:
         tuple[nd.array, int, int]: A tuple containing the image array,
@@ -114,37 +141,148 @@ def read_one_frame(
     Throws:
         StopIteration: If the process has no more frames
     """
-    image_buffer = BytesIO()
-    (width, height, _) = ppm_header_parser(
-        process, cast(BytesIO,
-                      process.stdout), image_buffer)
-
-    image_buffer.write(process.stdout.read(width * height * DEPTH))
-    image_buffer.seek(0)
-    image = Image.open(image_buffer)
-    image.resize((EXPECTED_WIDTH, EXPECTED_HEIGHT))
-    image_array = np.array(image)
-    return (image_array, width, height)
+    return create_frame_reader(process, layout, ring_size=1).read()
 
 
-def scrutinize_with_images_and_thresholds(  # pylint: disable=too-many-locals
+@dataclass
+class ScrutinizeOptions:
+    """
+    Knobs for scrutinize_with_images_and_thresholds. The defaults
+    evaluate every frame.
+
+    Adaptive sampling: while the detector square is present and every
+    square that has not crossed its threshold yet scores more than
+    sample_margin below it, only every sample_every-th frame is scored.
+    Any square coming within the margin, or the detector square
+    appearing or disappearing, switches to scoring every frame for at
+    least sample_hold seconds.
+
+    Times are frame timestamps (frame index / fps), except for the
+    overall timeout, which is wall-clock.
+
+    Pipelining: with workers > 0, frames are read into shared memory
+    and scored by that many worker processes (see pipeline.py), while
+    this process reads, checks the detector square and merges the
+    scores. 0 scores in this process. Both give the same results when
+    every frame is scored; with adaptive sampling, the pipelined loop
+    reacts to scores a few frames late.
+
+    Prefilter: squares that provably score below their threshold min
+    (minus sample_margin when sampling) skip the exact SSIM, see
+    ReferenceBank.score_cascade. The results are the same, but the
+    logged running maxima only count squares that got the exact SSIM.
+
+    Delta gate: squares whose pixels moved by at most delta_tolerance
+    since they were last scored keep their last score, see
+    FrameScorer. None scores every square of every evaluated frame.
+
+    Instrumentation: with instrument, every stage of every frame is
+    timed (wait for a free slot, read, detector check, gather, delta
+    gate, brightness adjust, SSIM, reduce into the running maxima,
+    checkpoint) into ScrutinizeStats.timers. With workers, gather to
+    ssim are timed in the workers, and wait includes the reduce of the
+    results that came back meanwhile.
+    """
+    fps: float = 30.0
+    grace_period: float = 5.0
+    timeout: float = 1800.0
+    sample_every: int = 1
+    sample_margin: float = 0.1
+    sample_hold: float = 1.0
+    workers: int = 0
+    prefilter: bool = True
+    delta_tolerance: Optional[int] = 0
+    instrument: bool = False
+
+
+@dataclass
+class ScrutinizeStats:
+    """
+    What scrutinize_with_images_and_thresholds ended up doing.
+    """
+    frames_read: int = 0
+    frames_evaluated: int = 0
+    sample_every: int = 1
+    sample_margin: float = 0.0
+    squares_retired: int = 0
+    squares_total: int = 0
+    prefilter_candidates: int = 0
+    prefilter_rejected_luminance: int = 0
+    prefilter_rejected_contrast: int = 0
+    delta_squares: int = 0
+    delta_unchanged: int = 0
+    timers: Optional[StageTimers] = None
+
+    def summary(self) -> str:
+        """
+        Summarizes the stats for logging
+
+        Returns:
+            str: The summary
+        """
+        ratio = self.frames_evaluated / max(self.frames_read, 1)
+        summary = (f'evaluated {self.frames_evaluated}/{self.frames_read} '
+                   f'frames ({ratio:.1%}), sample_every={self.sample_every}, '
+                   f'sample_margin={self.sample_margin}, '
+                   f'retired {self.squares_retired}/{self.squares_total} '
+                   'squares')
+        if self.prefilter_candidates:
+            rejected = (self.prefilter_rejected_luminance
+                        + self.prefilter_rejected_contrast)
+            hits = self.prefilter_candidates - rejected
+            summary += (
+                f', prefilter hit {hits}/{self.prefilter_candidates} '
+                f'({hits / self.prefilter_candidates:.1%}), rejected '
+                f'{self.prefilter_rejected_luminance} on luminance and '
+                f'{self.prefilter_rejected_contrast} on contrast')
+        if self.delta_squares:
+            summary += (f', delta gate skipped {self.delta_unchanged}/'
+                        f'{self.delta_squares} squares '
+                        f'({self.delta_unchanged / self.delta_squares:.1%})')
+        return summary
+
+
+def scrutinize_with_images_and_thresholds(  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
         process: subprocess.Popen,
-        images_array: list[list[SourceImageTuple]],
+        images_array: list[list[SourceImageTuple] | ReferenceBank],
         thresholds_array: list[np.ndarray],
         detector_squares: list[np.ndarray],
-        adjustment_value: list[float],
+        adjustment_value: float | list[float],
+        layout: Optional[FrameLayout] = None,
+        options: Optional[ScrutinizeOptions] = None,
+        stats: Optional[ScrutinizeStats] = None,
+        checkpoint: Optional[Checkpointer] = None,
+        first_frames: Optional[list[np.ndarray]] = None,
 ) -> list[list[bool]]:
     """
     Scrutinize the frames of a process. The process must output images
-    in PPM file format within stdout.
+    in PPM file format within stdout, or rawvideo frames in the given
+    layout.
 
     Args:
         process (subprocess.Popen): The process
-        images_array (list[list[SourceImageTuple]]): The images
+        images_array (list[list[SourceImageTuple] | ReferenceBank]): The
+            images. Every bank is scored in one batched SSIM pass per frame
         thresholds_array (list[np.ndarray]): The thresholds
         detector_squares (np.ndarray): The detector square. If this square is no longer
-                                       detected, the function will stop
-        adjustment_value (list[float]): The adjustment value
+                                       detected, the function will stop.
+                                       It also stops as soon as every
+                                       square has been found
+        adjustment_value (float | list[float]): The brightness gain of
+            each bank, or one gain for all of them. Only the squares
+            that get scored are adjusted, and the detector squares are
+            expected to be adjusted by the same gain already
+        layout (Optional[FrameLayout]): The layout of rawvideo frames,
+                                        e.g. ROI_LAYOUT. None for PPM
+        options (Optional[ScrutinizeOptions]): The options
+        stats (Optional[ScrutinizeStats]): If given, filled in with
+                                           what happened
+        checkpoint (Optional[Checkpointer]): If given, resumed from
+            before the first frame, then written every interval and
+            once more when the function returns or is interrupted
+        first_frames (Optional[list[np.ndarray]]): Frames already read
+            from the process (e.g. to detect the streamer). They are
+            scored first, as the first frames of the stream
 
     Returns:
         list[list[bool]]: A list of booleans. If true, it means that the
@@ -152,67 +290,205 @@ def scrutinize_with_images_and_thresholds(  # pylint: disable=too-many-locals
                           somewhere. False otherwise
     """
     assert process.stdout is not None
+    reader = create_frame_reader(process, layout)
+    options = options or ScrutinizeOptions()
+    stats = stats or ScrutinizeStats()
+    stats.sample_every = options.sample_every
+    stats.sample_margin = options.sample_margin
+    timers = StageTimers() if options.instrument else NULL_TIMERS
+
+    banks = [images if isinstance(images, ReferenceBank)
+             else ReferenceBank.from_images(images)
+             for images in images_array]
+    threshold_means = [np.asarray(thresholds)[:, 0]
+                       for thresholds in thresholds_array]
+    threshold_mins = [np.asarray(thresholds)[:, 1]
+                      for thresholds in thresholds_array]
+    gains = list(adjustment_value) if isinstance(adjustment_value, list) \
+        else [adjustment_value] * len(banks)
+    margin = options.sample_margin if options.sample_every > 1 else 0.0
+    cutoffs = [mins - margin for mins in threshold_mins] \
+        if options.prefilter else None
 
     start_time = time.time()
-    ssim_scores_array = [[-1.0] * len(images) for images in images_array]
+    ssim_scores_array = [np.full(len(bank), -1.0) for bank in banks]
     ssim_mismatch_time = None  # This is init once for optimization purposes
+    frame_layout: Optional[FrameLayout] = None
+    scorer: Optional[FrameScorer] = None
+    pipeline: Optional[ScoringPipeline] = None
+    detector_found: Optional[list[bool]] = None
+    dense_until = 0.0
+    # Squares still waiting to cross their threshold. Retired squares are
+    # no longer scored, and once every square is retired there is nothing
+    # left to look for
+    active = [np.ones(len(bank), dtype=bool) for bank in banks]
+    buffered_frames = deque(first_frames or [])
+
+    def found_squares() -> list[list[bool]]:
+        return [(ssim_scores + (means - mins) >= means).tolist()
+                for ssim_scores, means, mins
+                in zip(ssim_scores_array, threshold_means, threshold_mins)]
+
+    def write_checkpoint(complete: bool) -> None:
+        assert checkpoint is not None
+        checkpoint.write(
+            ssim_scores_array, found_squares(), stats.frames_read,
+            stats.frames_evaluated, detector_found,
+            None if ssim_mismatch_time is None
+            else stats.frames_read / options.fps - ssim_mismatch_time,
+            complete)
+
+    if checkpoint is not None:
+        for jdx, previous in enumerate(checkpoint.resume(banks)):
+            if previous is not None:
+                np.maximum(ssim_scores_array[jdx], previous,
+                           out=ssim_scores_array[jdx])
+                active[jdx] = ssim_scores_array[jdx] + (
+                    threshold_means[jdx] - threshold_mins[jdx]) \
+                    < threshold_means[jdx]
+
+    def merge(frame_idx: int, scores_array: list[np.ndarray]) -> None:
+        nonlocal dense_until
+        tick = timers.now()
+        timestamp = frame_idx / options.fps
+        for jdx, (scores, ssim_scores) in enumerate(
+                zip(scores_array, ssim_scores_array)):
+            np.maximum(ssim_scores, scores, out=ssim_scores)
+            pending = ssim_scores + (threshold_means[jdx]
+                                     - threshold_mins[jdx]) \
+                < threshold_means[jdx]
+            np.logical_and(active[jdx], pending, out=active[jdx])
+
+            if options.sample_every > 1 and \
+               np.any(pending & (scores + options.sample_margin
+                                 >= threshold_mins[jdx])):
+                dense_until = max(dense_until,
+                                  timestamp + options.sample_hold)
+        timers.lap('reduce', tick)
+
+    def all_retired() -> bool:
+        return not any(mask.any() for mask in active)
+
     intent_to_quit = False
-    while process.poll() is None and not intent_to_quit:
-        if time.time() - start_time > 1800:
-            logging.warning('Monitoring timeout. Might want to alert the dev.')
-            break
+    completed = False
+    try:
+        while (buffered_frames or process.poll() is None) \
+                and not intent_to_quit:
+            tick = timers.now()
+            if checkpoint is not None and checkpoint.due():
+                write_checkpoint(complete=False)
+                tick = timers.lap('checkpoint', tick)
+            if all_retired():
+                logging.info('Every square has crossed its threshold after '
+                             '%d frames. Stopping early.', stats.frames_read)
+                break
+            if time.time() - start_time > options.timeout:
+                logging.warning('Monitoring timeout. Might want to alert the dev.')
+                break
+
+            slot, buffer = None, None
+            if pipeline is not None:
+                slot, buffer = pipeline.next_slot()
+                tick = timers.lap('wait', tick)
+            if buffered_frames:
+                image_array = buffered_frames.popleft()
+                height, width = image_array.shape[:2]
+                if buffer is not None:
+                    buffer[...] = image_array
+                    image_array = buffer
+            else:
+                try:
+                    (image_array, width, height) = reader.read(buffer)
+                except StopIteration:
+                    break
+            tick = timers.lap('read', tick)
 
+            frame_idx = stats.frames_read
+            timestamp = frame_idx / options.fps
+            stats.frames_read += 1
+
+            if scorer is None:
+                frame_layout = layout or full_frame_layout(width, height,
+                                                           SQUARE_SIZE)
+                scorer = FrameScorer(banks, frame_layout, SQUARE_SIZE, gains,
+                                     cutoffs, options.delta_tolerance)
+                scorer.timers = timers
+                if options.workers > 0:
+                    pipeline = ScoringPipeline(scorer, height, width,
+                                               options.workers, merge)
+            assert frame_layout is not None
+
+            detector_square = frame_layout.dynamic_detector_square(
+                image_array, SQUARE_SIZE)
+            found = []
+            for idx in range(len(banks)):
+                if calculate_ssim(scorer.adjust(detector_square, gains[idx]),
+                                  detector_squares[idx]) < DETECTOR_THRESHOLD:
+                    found.append(False)
+                    if ssim_mismatch_time is None:
+                        ssim_mismatch_time = timestamp
+                        logging.info('Detector square not found! Grace period started.')
+                    elif timestamp - ssim_mismatch_time > options.grace_period:
+                        logging.info('Detector square not found after %d seconds.',
+                                     options.grace_period)
+                        intent_to_quit = True
+                        break
+                else:
+                    found.append(True)
+                    if ssim_mismatch_time is not None:
+                        logging.info('Detector square recovered after lost for %d seconds',
+                                     timestamp - ssim_mismatch_time)
+                        ssim_mismatch_time = None
+
+            if found != detector_found or not all(found):
+                dense_until = timestamp + options.sample_hold
+            detector_found = found
+            tick = timers.lap('detector', tick)
+
+            if options.sample_every > 1 and timestamp >= dense_until and \
+               frame_idx % options.sample_every:
+                if pipeline is not None and slot is not None:
+                    pipeline.release(slot)
+                continue
+
+            stats.frames_evaluated += 1
+            if pipeline is not None and slot is not None:
+                pipeline.submit(slot, frame_idx,
+                                [mask.copy() for mask in active])
+                timers.lap('submit', tick)
+            else:
+                merge(frame_idx, scorer.score(image_array, active))
+        completed = True
+    finally:
         try:
-            (image_array, width, height) = read_one_frame(process)
-        except StopIteration:
-            break
-
-        image_array = (image_array * adjustment_value).astype(np.uint8)
-        for idx, image in enumerate(images_array):
-            if calculate_ssim(
-                    extract_dynamic_detector_square(image_array, SQUARE_SIZE),
-                    detector_squares[idx]) < DETECTOR_THRESHOLD:
-                if ssim_mismatch_time is None:
-                    ssim_mismatch_time = time.time()
-                    logging.info('Detector square not found! Grace period started.')
-                elif time.time() - ssim_mismatch_time > 5:
-                    logging.info('Detector square not found after 5 seconds.')
-                    intent_to_quit = True
-                    break
-            elif ssim_mismatch_time is not None:
-                logging.info('Detector square recovered after lost for %d seconds',
-                             time.time() - ssim_mismatch_time)
-                ssim_mismatch_time = None
-
-        image_array = nparray_crop_frame(image_array, height, width)
-        segments = nparray_segment_into_squares(image_array, SQUARE_SIZE)
-
-        ssim_results_array = [map(process_squares_with_target_image,
-                                  ((segments, tuple) for tuple in images))
-                              for images in images_array]
-        ssim_scores_array = [[max(x, y) for x, y in zip(ssim_scores, ssim_results)]
-                             for (ssim_scores, ssim_results)
-                             in zip(ssim_scores_array, ssim_results_array)]
-
-    results = []
+            if pipeline is not None:
+                pipeline.close()
+        finally:
+            if checkpoint is not None:
+                write_checkpoint(complete=completed)
+
+    if options.instrument:
+        stats.timers = timers
+    if scorer is not None:
+        for field, count in zip(COUNT_FIELDS, scorer.counts):
+            setattr(stats, field, int(count))
+    stats.squares_retired = sum(int((~mask).sum()) for mask in active)
+    stats.squares_total = sum(len(mask) for mask in active)
+    logging.info('Scrutinize stats: %s', stats.summary())
     logging.info('SSIM scores: %s', [[float(score) for score in ssim_scores] for ssim_scores in ssim_scores_array])
-    for jdx, ssim_scores in enumerate(ssim_scores_array):
-        intermediary = []
-        for idx, score in enumerate(ssim_scores):
-            mean, mini = thresholds_array[jdx][idx]
-            intermediary.append(bool(score + (mean - mini) >= mean))
-        results.append(intermediary)
-    return results
+    return found_squares()
 
 
 if __name__ == '__main__':
-    IMAGES: list[SourceImageTuple] = []
-    THRESHOLDS: np.ndarray
     SRC_DIRECTORY_NEURO = input('Neuro Source Directory: ')
     SRC_DIRECTORY_EVIL = input('Evil Source Directory: ')
     THRESHOLDS_FILE_NEURO = input('Thresholds File (Neuro): ')
     THRESHOLDS_FILE_EVIL = input('Thresholds File (Evil): ')
     LINK = input('YouTube Link: ')
+    OPTIONS = ScrutinizeOptions(
+        sample_every=int(os.getenv('SCRUTINIZE_SAMPLE_EVERY', '1')),
+        sample_margin=float(os.getenv('SCRUTINIZE_SAMPLE_MARGIN', '0.1')))
+    STATS = ScrutinizeStats()
 
     # Preloaders
     if not os.path.exists(SRC_DIRECTORY_NEURO):
@@ -235,31 +511,37 @@ if __name__ == '__main__':
     neuro_ds = np.array(Image.open('detectors/neuro_detector.png'))
     evil_ds = np.array(Image.open('detectors/evil_detector.png'))
 
-    with create_process_for_720p_video_for_youtube(LINK) as PROCESS:
+    # Timestamps, sample_hold and timeouts assume OPTIONS.fps frames a
+    # second, so a 720p60 source is resampled to it
+    with create_process_for_720p_video_for_youtube(
+            LINK, roi=True, fps=round(OPTIONS.fps)) as PROCESS:
         assert PROCESS is not None
 
-        FIRST_FRAME = read_one_frame(PROCESS)[0]
+        FIRST_FRAME = read_one_frame(PROCESS, ROI_LAYOUT)[0]
         DETECTED_STREAMER, ADJUSTMENT_VALUE = whose_stream(FIRST_FRAME,
                                                            tutel_ds,
                                                            neuro_ds,
                                                            evil_ds,
-                                                           SQUARE_SIZE)
+                                                           SQUARE_SIZE,
+                                                           ROI_LAYOUT)
 
         print(f'This is {DETECTED_STREAMER}\'s stream')
         assert DETECTED_STREAMER not in ('dunno', 'tutel')
 
-        IMAGES = load_images_from_directory(SRC_DIRECTORY_NEURO if
-                                            DETECTED_STREAMER == 'neuro'
-                                            else SRC_DIRECTORY_EVIL)
-        THRESHOLDS = load_thresholds(THRESHOLDS_FILE_NEURO if
-                                     DETECTED_STREAMER == 'neuro'
-                                     else THRESHOLDS_FILE_EVIL)
-
-        assert len(IMAGES) == len(THRESHOLDS)
+        BANK = load_bank(SRC_DIRECTORY_NEURO if
+                         DETECTED_STREAMER == 'neuro'
+                         else SRC_DIRECTORY_EVIL,
+                         THRESHOLDS_FILE_NEURO if
+                         DETECTED_STREAMER == 'neuro'
+                         else THRESHOLDS_FILE_EVIL)
+        assert BANK.thresholds is not None
 
         RESULTS = scrutinize_with_images_and_thresholds(
-            PROCESS, [IMAGES], [THRESHOLDS],
-            [extract_dynamic_detector_square(FIRST_FRAME, SQUARE_SIZE)],
-            ADJUSTMENT_VALUE
+            PROCESS, [BANK], [BANK.thresholds],
+            [brightness_lut(ADJUSTMENT_VALUE)[
+                ROI_LAYOUT.dynamic_detector_square(FIRST_FRAME, SQUARE_SIZE)]],
+            ADJUSTMENT_VALUE, ROI_LAYOUT, OPTIONS, STATS,
+            first_frames=[FIRST_FRAME]
         )
         print(RESULTS)
+        print(STATS.summary())
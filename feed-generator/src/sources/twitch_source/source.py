@@ -7,6 +7,8 @@ from typing import Optional
 
 import requests
 
+from utils import conditional_get
+
 
 # pylint: disable=too-few-public-methods
 class TwitchSource:
@@ -27,17 +29,20 @@ class TwitchSource:
 
         try:
             logging.info("Retrieving information for %s", self.who)
-            response = requests.get(
-                "https://raw.githubusercontent.com/neuro-arg/"
-                f"arg-monitoring/publish/{self.who}.txt", timeout=5)
-
-            if response.status_code == 404:
+            try:
+                content, _ = conditional_get(
+                    "https://raw.githubusercontent.com/neuro-arg/"
+                    f"arg-monitoring/publish/{self.who}.txt",
+                    keep_body=True)
+                assert content is not None
+                self.result = content.decode('utf-8')
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
                 logging.info(
                     "Could not get information for %s, it does not exist",
                     self.who)
                 self.result = ''
-            else:
-                self.result = response.content.decode('utf-8')
 
             return self.result
         except:  # pylint: disable=bare-except # noqa: E722
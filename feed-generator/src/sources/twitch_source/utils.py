@@ -2,10 +2,15 @@
 Utility functions
 """
 
+import glob
+import hashlib
+import os
 import subprocess
 import logging
+from collections import Counter, namedtuple
+from dataclasses import dataclass
 from io import BytesIO
-from typing import Literal
+from typing import BinaryIO, Literal, Optional
 
 import cv2
 import numpy as np
@@ -26,6 +31,226 @@ CROPPED_HEIGHT = int(EXPECTED_HEIGHT * CROP_RATIO_Y -
 
 WHOSE_STREAM_SQUARE_NUMBER = 34
 DETECTOR_THRESHOLD = 0.91
+# Brightness gains whose_stream() tries on the stream, i.e. 1.00 to 1.69
+WHOSE_STREAM_GAINS = np.arange(100, 170) / 100.0
+
+IMAGES_FILENAME_PATTERN = r'square_(\d+)_(\d+).png'
+
+# Tuples
+SourceImageTuple = namedtuple('SourceImageTuple',
+                              ['array', 'square_number'])
+# A line of a training clips list: `url [start [end]]`. Times are in
+# seconds, None for the start/end of the video
+TrainingClip = namedtuple('TrainingClip', ['url', 'start', 'end'])
+
+# Prefers 720p60, like create_process_for_720p_video_for_youtube
+YT_DLP_720P_FORMAT = ('bv*[height=720][fps>=50]/bv*[height=720]'
+                      '/b[height=720]/b')
+
+
+@dataclass(frozen=True)
+class FrameLayout:
+    """
+    Where the regions that get looked at live inside a decoded frame:
+    the cropped grid of squares, the dynamic detector square and the
+    square whose_stream() looks at.
+
+    full_frame_layout() describes a whole frame; ROI_LAYOUT describes
+    the smaller frames produced by roi_ffmpeg_arguments().
+    """
+    width: int
+    height: int
+    grid_top: int
+    grid_left: int
+    grid_height: int
+    grid_width: int
+    dynamic_detector: tuple[int, int]
+    whose_stream_detector: tuple[int, int]
+
+    def crop(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Crops the grid out of a frame, like nparray_crop_frame
+
+        Args:
+            frame (np.ndarray): The frame
+
+        Returns:
+            np.ndarray: The cropped grid
+        """
+        return frame[self.grid_top:self.grid_top + self.grid_height,
+                     self.grid_left:self.grid_left + self.grid_width]
+
+    def dynamic_detector_square(self, frame: np.ndarray,
+                                square_size: int) -> np.ndarray:
+        """
+        Like extract_dynamic_detector_square
+
+        Args:
+            frame (np.ndarray): The frame
+            square_size (int): The size of the square
+
+        Returns:
+            np.ndarray: The detector square
+        """
+        top, left = self.dynamic_detector
+        return frame[top:top + square_size, left:left + square_size]
+
+    def whose_stream_square(self, frame: np.ndarray,
+                            square_size: int) -> np.ndarray:
+        """
+        Gets the square whose_stream() compares with the detectors
+
+        Args:
+            frame (np.ndarray): The frame
+            square_size (int): The size of the square
+
+        Returns:
+            np.ndarray: The square
+        """
+        top, left = self.whose_stream_detector
+        return frame[top:top + square_size, left:left + square_size]
+
+
+def full_frame_layout(width: int, height: int,
+                      square_size: int = 20) -> FrameLayout:
+    """
+    Describes a whole decoded frame
+
+    Args:
+        width (int): The frame width
+        height (int): The frame height
+        square_size (int): The size of the squares
+
+    Returns:
+        FrameLayout: The layout
+    """
+    top = int(CROP_OFFSET_RATIO_Y * height)
+    left = int(CROP_OFFSET_RATIO_X * width)
+    return FrameLayout(
+        width, height, top, left,
+        int(CROP_RATIO_Y * height) - top, int(CROP_RATIO_X * width) - left,
+        (0, 0), (0, (WHOSE_STREAM_SQUARE_NUMBER - 1) * square_size))
+
+
+class SquareGather:
+    """
+    Pulls a fixed set of grid squares out of frames with a single
+    fancy-indexing operation into a preallocated batch, instead of
+    segmenting the whole grid every frame.
+
+    Squares are numbered like nparray_segment_into_squares numbers
+    them. Every square is gathered once, even if several references
+    (or several banks) look at it; positions() maps square numbers to
+    their place in the batch.
+    """
+    def __init__(self, square_numbers: np.ndarray, layout: FrameLayout,
+                 square_size: int = 20, depth: int = 3) -> None:
+        self.square_numbers = np.unique(np.asarray(square_numbers,
+                                                   dtype=np.intp))
+        self.layout = layout
+        columns = layout.grid_width // square_size
+        rows = layout.grid_height // square_size
+        if len(self.square_numbers) and \
+           self.square_numbers[-1] >= columns * rows:
+            raise ValueError(f'Square {self.square_numbers[-1]} is outside '
+                             f'of the {columns}x{rows} grid')
+
+        offsets = np.arange(square_size)
+        top = layout.grid_top + (self.square_numbers // columns) * square_size
+        left = layout.grid_left + (self.square_numbers % columns) * square_size
+        self.index = ((top[:, None, None] + offsets[None, :, None])
+                      * layout.width
+                      + left[:, None, None] + offsets[None, None, :])
+        self.batch = np.empty(
+            (len(self.square_numbers), square_size, square_size, depth),
+            dtype=np.uint8)
+
+    def positions(self, square_numbers: np.ndarray) -> np.ndarray:
+        """
+        Finds where some squares end up in the batch
+
+        Args:
+            square_numbers (np.ndarray): Square numbers, all of which
+                                         were given to the constructor
+
+        Returns:
+            np.ndarray: Indices into the batch
+        """
+        return np.searchsorted(self.square_numbers, square_numbers)
+
+    def gather(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Gathers the squares of a frame into the batch. The batch is
+        overwritten by the next call; copy it to keep it.
+
+        Args:
+            frame (np.ndarray): A frame in the layout given to the
+                                constructor
+
+        Returns:
+            np.ndarray: The batch, of shape (N, S, S, depth)
+        """
+        np.take(frame.reshape(-1, frame.shape[2]), self.index, axis=0,
+                out=self.batch)
+        return self.batch
+
+
+def roi_layout(square_size: int = 20) -> FrameLayout:
+    """
+    Describes the frames produced by roi_ffmpeg_arguments(): a strip
+    of square_size rows holding the dynamic detector square and the
+    whose_stream square side by side, on top of the cropped grid
+
+    Args:
+        square_size (int): The size of the squares
+
+    Returns:
+        FrameLayout: The layout
+    """
+    full = full_frame_layout(EXPECTED_WIDTH, EXPECTED_HEIGHT, square_size)
+    return FrameLayout(max(full.grid_width, 2 * square_size),
+                       square_size + full.grid_height,
+                       square_size, 0, full.grid_height, full.grid_width,
+                       (0, 0), (0, square_size))
+
+
+ROI_LAYOUT = roi_layout()
+
+
+def roi_ffmpeg_arguments(fps: Optional[int] = None,
+                         square_size: int = 20) -> str:
+    """
+    Generates the ffmpeg output arguments that emit only the regions in
+    ROI_LAYOUT as rgb24 rawvideo, instead of whole PPM frames. Frames
+    are scaled to EXPECTED_WIDTH x EXPECTED_HEIGHT first, like
+    everywhere else.
+
+    Args:
+        fps (Optional[int]): Forces this frame rate, if given
+        square_size (int): The size of the squares
+
+    Returns:
+        str: The arguments, to be put after the ffmpeg input
+    """
+    full = full_frame_layout(EXPECTED_WIDTH, EXPECTED_HEIGHT, square_size)
+    roi = roi_layout(square_size)
+    dyn_top, dyn_left = full.dynamic_detector
+    whose_top, whose_left = full.whose_stream_detector
+    fps_filter = f',fps={fps}' if fps else ''
+    graph = (
+        f'[0:v]scale={EXPECTED_WIDTH}:{EXPECTED_HEIGHT}{fps_filter},'
+        'split=3[full_grid][full_dyn][full_whose];'
+        f'[full_grid]crop={full.grid_width}:{full.grid_height}'
+        f':{full.grid_left}:{full.grid_top}[grid];'
+        f'[full_dyn]crop={square_size}:{square_size}'
+        f':{dyn_left}:{dyn_top}[dyn];'
+        f'[full_whose]crop={square_size}:{square_size}'
+        f':{whose_left}:{whose_top}[whose];'
+        f'[dyn][whose]hstack=inputs=2,pad={roi.width}:{square_size}[strip];'
+        f'[grid]pad={roi.width}:{full.grid_height}[padded_grid];'
+        '[strip][padded_grid]vstack=inputs=2,format=rgb24[roi]')
+    return (f'-filter_complex "{graph}" -map "[roi]"'
+            ' -f rawvideo -pix_fmt rgb24 -')
 
 
 def nparray_crop_frame(image_array: np.ndarray,
@@ -109,12 +334,17 @@ def resize_image(image_array: np.ndarray, new_height: int,
 
 
 def create_process_for_720p_video_for_youtube(
-        youtube_url: str) -> subprocess.Popen:
+        youtube_url: str, roi: bool = False,
+        fps: Optional[int] = None) -> subprocess.Popen:
     """
     Creates a process for youtube-dl
 
     Args:
         youtube_url (str): The URL of the video
+        roi (bool): If true, the process outputs rawvideo frames in
+                    ROI_LAYOUT instead of whole PPM frames
+        fps (Optional[int]): Forces this frame rate in ROI mode, if
+                             given
 
     Returns:
         subprocess.Popen: The process
@@ -134,24 +364,126 @@ def create_process_for_720p_video_for_youtube(
             segment for segment in output.split('\n')
             if "720p60" in segment][0].split(' ')[0]
 
+    output_args = roi_ffmpeg_arguments(fps) if roi \
+        else "-c:v ppm -f image2pipe -"
     command = (f"youtube-dl -f {final_code} -o - '{youtube_url}'"
-               " | ffmpeg"
-               " -i - -c:v ppm -f image2pipe -")
+               f" | ffmpeg -i - {output_args}")
     return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
 
 
-def create_process_for_ffmpeg_video(path: str) -> subprocess.Popen:
+def parse_timestamp(text: str) -> float:
+    """
+    Parses a time, either in seconds or as [HH:]MM:SS[.fff]
+
+    Args:
+        text (str): The time
+
+    Returns:
+        float: The time in seconds
+
+    Throws:
+        ValueError: If the time is malformed
+    """
+    seconds = 0.0
+    for part in text.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_training_clip(line: str) -> TrainingClip:
+    """
+    Parses a line of a training clips list: a URL, optionally followed
+    by the start and end of the window to analyze, e.g.
+    `https://www.youtube.com/watch?v=... 0:05 1:30`. A `-` keeps the
+    start/end of the video.
+
+    Args:
+        line (str): The line
+
+    Returns:
+        TrainingClip: The clip
+
+    Throws:
+        ValueError: If the line is malformed
+    """
+    url, *window = line.split()
+    if len(window) > 2:
+        raise ValueError(f'Expected `url [start [end]]`, got {line!r}')
+    start, end = [parse_timestamp(time) if time != '-' else None
+                  for time in window] + [None] * (2 - len(window))
+    if start is not None and end is not None and end <= start:
+        raise ValueError(f'The window of {url} ends before it starts')
+    return TrainingClip(url, start, end)
+
+
+def download_youtube_clip(clip: TrainingClip, directory: str) -> str:
+    """
+    Downloads the window of a clip at 720p with yt-dlp, unless the
+    directory already has it. Only the window is downloaded.
+
+    Args:
+        clip (TrainingClip): The clip
+        directory (str): Where to keep the downloaded clips
+
+    Returns:
+        str: The path of the video
+
+    Throws:
+        subprocess.CalledProcessError: If yt-dlp fails
+    """
+    name = hashlib.sha256(
+        f'{clip.url} {clip.start} {clip.end}'.encode('utf-8')).hexdigest()[:16]
+    existing = glob.glob(os.path.join(glob.escape(directory), f'{name}.*'))
+    existing = [path for path in existing
+                if not os.path.basename(path).startswith(f'{name}.download.')]
+    if existing:
+        logging.debug('Clip %s is cached at %s', clip.url, existing[0])
+        return existing[0]
+
+    os.makedirs(directory, exist_ok=True)
+    # Leftovers of an interrupted download would look finished to yt-dlp
+    for leftover in glob.glob(os.path.join(glob.escape(directory),
+                                           f'{name}.download.*')):
+        os.remove(leftover)
+    command = ['yt-dlp', '--quiet', '--no-playlist', '--no-part',
+               '--force-overwrites',
+               '-f', YT_DLP_720P_FORMAT,
+               '-o', os.path.join(directory, f'{name}.download.%(ext)s')]
+    if clip.start is not None or clip.end is not None:
+        command += ['--download-sections',
+                    f'*{clip.start or 0}-{clip.end or "inf"}']
+    subprocess.run(command + [clip.url], check=True)
+
+    # Only the finished download gets the final name, so an interrupted
+    # one is downloaded again
+    downloaded = glob.glob(os.path.join(glob.escape(directory),
+                                        f'{name}.download.*'))[0]
+    path = os.path.join(directory,
+                        f'{name}.{downloaded.rsplit(".download.", 1)[1]}')
+    os.replace(downloaded, path)
+    logging.info('Downloaded clip %s to %s', clip.url, path)
+    return path
+
+
+def create_process_for_ffmpeg_video(path: str, roi: bool = False,
+                                    fps: Optional[int] = None
+                                    ) -> subprocess.Popen:
     """
     Creates a process for ffmpeg
 
     Args:
         path (str): The path to the video
+        roi (bool): If true, the process outputs rawvideo frames in
+                    ROI_LAYOUT instead of whole PPM frames
+        fps (Optional[int]): Forces this frame rate in ROI mode, if
+                             given
 
     Returns:
         subprocess.Popen: The process
     """
-    command = (f"ffmpeg"
-               f" -i {path} -vf scale=1280:720 -c:v ppm -f image2pipe -")
+    output_args = roi_ffmpeg_arguments(fps) if roi \
+        else "-vf scale=1280:720 -c:v ppm -f image2pipe -"
+    command = f"ffmpeg -i {path} {output_args}"
     return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,)
 
 
@@ -184,6 +516,119 @@ def ppm_header_parser(
     return width, height, color_val
 
 
+def read_exactly(stream: BinaryIO, view: memoryview) -> bool:
+    """
+    Fills a buffer from a stream, looping over short reads
+
+    Args:
+        stream (BinaryIO): The stream
+        view (memoryview): The buffer to fill
+
+    Returns:
+        bool: False if the stream ended before the buffer was full
+    """
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            return False
+        filled += count
+    return True
+
+
+class RawFrameReader:
+    """
+    Reads fixed-size rgb24 rawvideo frames out of a stream (usually an
+    ffmpeg pipe) straight into a small ring of preallocated uint8
+    buffers with readinto().
+
+    The returned arrays are views into the ring: a frame stays valid
+    until ring_size more frames have been read. Copy it to keep it.
+    """
+    def __init__(self, stream: BinaryIO, width: int, height: int,
+                 ring_size: int = 2) -> None:
+        self.stream = stream
+        self.ring_size = ring_size
+        self.width = width
+        self.height = height
+        self.ring: list[np.ndarray] = []
+        self.frame_idx = 0
+
+    def _allocate(self) -> None:
+        self.ring = [
+            np.empty((self.height, self.width, 3), dtype=np.uint8)
+            for _ in range(self.ring_size)]
+
+    def _read_header(self) -> None:
+        if not self.ring:
+            self._allocate()
+
+    def read(self, out: Optional[np.ndarray] = None
+             ) -> tuple[np.ndarray, int, int]:
+        """
+        Reads one frame.
+
+        Args:
+            out (Optional[np.ndarray]): A contiguous (height, width, 3)
+                                        uint8 buffer to read into
+                                        instead of the ring, e.g.
+                                        shared memory
+
+        Returns:
+            tuple[np.ndarray, int, int]: A tuple containing the image
+                                         array, the width, and the
+                                         height
+
+        Throws:
+            StopIteration: If the stream has no more frames
+        """
+        self._read_header()
+
+        frame = self.ring[self.frame_idx % self.ring_size] if out is None \
+            else out
+        if not read_exactly(self.stream, memoryview(frame).cast('B')):
+            raise StopIteration
+
+        self.frame_idx += 1
+        return frame, self.width, self.height
+
+    def __iter__(self) -> 'RawFrameReader':
+        return self
+
+    def __next__(self) -> tuple[np.ndarray, int, int]:
+        return self.read()
+
+
+class PPMFrameReader(RawFrameReader):
+    """
+    Reads PPM frames like RawFrameReader does rawvideo frames.
+
+    The P6 header is parsed line by line, like ppm_header_parser, on
+    the first frame only. ffmpeg writes the exact same header in front
+    of every frame, so afterwards the header and pixels of a frame are
+    read with readinto() and the header is only compared.
+    """
+    def __init__(self, stream: BinaryIO, ring_size: int = 2) -> None:
+        super().__init__(stream, 0, 0, ring_size)
+        self.header = b''
+        self._header_buffer = bytearray()
+
+    def _read_header(self) -> None:
+        if not self.ring:
+            header = next(self.stream)
+            width_height_raw = next(self.stream)
+            color_val_raw = next(self.stream)
+            self.width, self.height = map(int, width_height_raw.split())
+            self.header = header + width_height_raw + color_val_raw
+            self._header_buffer = bytearray(len(self.header))
+            self._allocate()
+        elif not read_exactly(self.stream, memoryview(self._header_buffer)):
+            raise StopIteration
+        elif self._header_buffer != self.header:
+            raise ValueError('PPM frame header changed mid-stream: '
+                             f'{bytes(self._header_buffer)!r}')
+
+
 def calculate_ssim(target: np.ndarray, reference: np.ndarray) -> float:
     """
     Calculates the difference using SSIM
@@ -198,6 +643,22 @@ def calculate_ssim(target: np.ndarray, reference: np.ndarray) -> float:
     return ssim(target, reference, channel_axis=2)
 
 
+def brightness_lut(gain: float) -> np.ndarray:
+    """
+    Builds the lookup table that brightness-adjusts uint8 pixels by a
+    gain, without going through float64. Pixels saturate at 255: with a
+    gain above 1, wrapping around (as the old float path did) would turn
+    the brightest pixels dark before they are scored.
+
+    Args:
+        gain (float): The gain
+
+    Returns:
+        np.ndarray: The 256-entry uint8 table
+    """
+    return np.clip(np.arange(256) * gain, 0, 255).astype(np.uint8)
+
+
 def calculate_rgb_diff(target: np.ndarray, reference: np.ndarray) -> float:
     """
     Calcualtes the difference using RGB pixel values
@@ -232,12 +693,97 @@ def extract_dynamic_detector_square(frame: np.ndarray,
     return frame[:square_size, :square_size]
 
 
+StreamerLiteral = Literal['tutel', 'neuro', 'evil', 'dunno']
+
+
+def detector_diffs(squares: np.ndarray,
+                   detector_squares: np.ndarray) -> np.ndarray:
+    """
+    Computes calculate_rgb_diff() of every square, scaled by every gain
+    of WHOSE_STREAM_GAINS, against every detector square in one
+    broadcast operation.
+
+    Args:
+        squares (np.ndarray): uint8 squares of shape (F, S, S, D), e.g.
+                              the same square of F frames
+        detector_squares (np.ndarray): uint8 detectors of shape
+                                       (N, S, S, D)
+
+    Returns:
+        np.ndarray: The diffs, of shape (F, N, len(WHOSE_STREAM_GAINS))
+    """
+    scaled = (squares[:, np.newaxis]
+              * WHOSE_STREAM_GAINS[:, np.newaxis, np.newaxis, np.newaxis]
+              ).astype(np.uint8)
+    # uint8 on purpose: same wraparound as calculate_rgb_diff
+    differences = scaled[:, np.newaxis] \
+        - detector_squares[np.newaxis, :, np.newaxis]
+    percent = (255 - differences.mean(axis=(3, 4, 5))) / 255.0
+    normalized = percent * 2.0 - 1.0
+    return 1 / (1 + np.exp(-normalized / 0.1))
+
+
+def _classify_diffs(tutel_diff: float, neuro_diff: float,
+                    evil_diff: float) -> StreamerLiteral:
+    if tutel_diff > neuro_diff and tutel_diff > evil_diff \
+       and tutel_diff > DETECTOR_THRESHOLD:
+        return 'tutel'
+
+    if neuro_diff > evil_diff and neuro_diff > DETECTOR_THRESHOLD:
+        return 'neuro'
+
+    if evil_diff > neuro_diff and evil_diff > DETECTOR_THRESHOLD:
+        return 'evil'
+
+    return 'dunno'
+
+
+def classify_streams(squares: np.ndarray,
+                     tutel_detector_square: np.ndarray,
+                     neuro_detector_square: np.ndarray,
+                     evil_detector_square: np.ndarray,
+                     ) -> list[tuple[StreamerLiteral, float]]:
+    """
+    Classifies the whose_stream squares of several frames at once
+
+    Args:
+        squares (np.ndarray): The squares, of shape (F, S, S, D)
+        tutel_detector_square (np.ndarray): The tutel detector
+        neuro_detector_square (np.ndarray): The neuro detector
+        evil_detector_square (np.ndarray): The evil detector
+
+    Returns:
+        list[tuple[StreamerLiteral, float]]: For every square, whose
+            stream it is and the gain that matched best. The gain is
+            1.0 for 'dunno'
+    """
+    detectors = np.stack([tutel_detector_square, neuro_detector_square,
+                          evil_detector_square])
+    diffs = detector_diffs(squares, detectors)
+    best_gains = diffs.argmax(axis=2)
+    best_diffs = diffs.max(axis=2)
+
+    results: list[tuple[StreamerLiteral, float]] = []
+    for frame_diffs, frame_gains in zip(best_diffs, best_gains):
+        logging.debug('Tutel, neuro, evil diffs: %s', frame_diffs)
+        streamer = _classify_diffs(*frame_diffs)
+        if streamer == 'dunno':
+            results.append((streamer, 1.0))
+        else:
+            detector_idx = ('tutel', 'neuro', 'evil').index(streamer)
+            results.append(
+                (streamer,
+                 float(WHOSE_STREAM_GAINS[frame_gains[detector_idx]])))
+    return results
+
+
 def whose_stream(target: np.ndarray,
                  tutel_detector_square: np.ndarray,
                  neuro_detector_square: np.ndarray,
                  evil_detector_square: np.ndarray,
-                 square_size: int) -> tuple[Literal['neuro', 'evil', 'dunno'],
-                                            float]:
+                 square_size: int,
+                 layout: Optional[FrameLayout] = None,
+                 ) -> tuple[StreamerLiteral, float]:
     """
     Determines based on the first frame whose stream is being watched
 
@@ -247,40 +793,58 @@ def whose_stream(target: np.ndarray,
         neuro_detector_square (np.ndarray): The neuro detector
         evil_detector_square (np.ndarray): The evil detector
         square_size (int): The size of the squares
+        layout (Optional[FrameLayout]): The layout of target. Defaults
+                                        to a whole frame
 
     Returns:
-        tuple[Literal['tutel', 'neuro', 'evil', 'dunno'], float]: The result
-    """
-    square = target[:square_size, (WHOSE_STREAM_SQUARE_NUMBER - 1)
-                    * square_size:
-                    WHOSE_STREAM_SQUARE_NUMBER * square_size]
-
-    tutel_diffs = [
-        calculate_rgb_diff((square * (i / 100.0)).astype(np.uint8),
-                           tutel_detector_square) for i in range(100, 170)]
-    neuro_diffs = [
-        calculate_rgb_diff((square * (i / 100.0)).astype(np.uint8),
-                           neuro_detector_square) for i in range(100, 170)]
-    evil_diffs = [
-        calculate_rgb_diff((square * (i / 100.0)).astype(np.uint8),
-                           evil_detector_square) for i in range(100, 170)]
-
-    tutel_idx, tutel_diff = max(enumerate(tutel_diffs), key=lambda x: x[1])
-    neuro_idx, neuro_diff = max(enumerate(neuro_diffs), key=lambda x: x[1])
-    evil_idx, evil_diff = max(enumerate(evil_diffs), key=lambda x: x[1])
-
-    logging.info('Tutel diff: %s', tutel_diff)
-    logging.info('Neuro diff: %s', neuro_diff)
-    logging.info('Evil diff: %s', evil_diff)
-
-    if tutel_diff > neuro_diff and tutel_diff > evil_diff \
-       and tutel_diff > DETECTOR_THRESHOLD:
-        return 'tutel', 1.0
-
-    if neuro_diff > evil_diff and neuro_diff > DETECTOR_THRESHOLD:
-        return 'neuro', 1.0
+        tuple[Literal['tutel', 'neuro', 'evil', 'dunno'], float]: The
+            result, and the gain the frames need to be multiplied with
+            to match the detector
+    """
+    return whose_stream_vote([target], tutel_detector_square,
+                             neuro_detector_square, evil_detector_square,
+                             square_size, layout)
+
+
+def whose_stream_vote(targets: list[np.ndarray],
+                      tutel_detector_square: np.ndarray,
+                      neuro_detector_square: np.ndarray,
+                      evil_detector_square: np.ndarray,
+                      square_size: int,
+                      layout: Optional[FrameLayout] = None,
+                      ) -> tuple[StreamerLiteral, float]:
+    """
+    Determines whose stream is being watched by classifying several
+    frames, e.g. the first second of the stream, and taking the
+    majority. Ties go to the streamer seen first.
 
-    if evil_diff > neuro_diff and evil_diff > DETECTOR_THRESHOLD:
-        return 'evil', 1.0
+    Args:
+        targets (list[np.ndarray]): The target images
+        tutel_detector_square (np.ndarray): The tutel detector
+        neuro_detector_square (np.ndarray): The neuro detector
+        evil_detector_square (np.ndarray): The evil detector
+        square_size (int): The size of the squares
+        layout (Optional[FrameLayout]): The layout of the targets.
+                                        Defaults to a whole frame
 
-    return 'dunno', 1.0
+    Returns:
+        tuple[Literal['tutel', 'neuro', 'evil', 'dunno'], float]: The
+            result, and the median of the best gains of the frames that
+            voted for it
+    """
+    if layout is None:
+        layout = full_frame_layout(targets[0].shape[1], targets[0].shape[0],
+                                   square_size)
+    squares = np.stack([layout.whose_stream_square(target, square_size)
+                        for target in targets])
+
+    votes = classify_streams(squares, tutel_detector_square,
+                             neuro_detector_square, evil_detector_square)
+    counts = Counter(streamer for streamer, _gain in votes)
+    logging.info('whose_stream votes over %d frames: %s', len(votes),
+                 dict(counts))
+
+    streamer = counts.most_common(1)[0][0]
+    gain = float(np.median([gain for voter, gain in votes
+                            if voter == streamer]))
+    return streamer, gain
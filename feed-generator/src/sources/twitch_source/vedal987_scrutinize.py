@@ -6,18 +6,21 @@ This is meant to be called from a GitHub workflow.
 
 import json
 import logging
+import os
+import shlex
+import signal
 import subprocess
 import sys
-import psutil
-import os
 
 import numpy as np
 from PIL import Image
 
-from scrutinize import (load_images_from_directory, load_thresholds,
-                        read_one_frame, scrutinize_with_images_and_thresholds,
-                        extract_dynamic_detector_square)
-from utils import whose_stream
+from checkpoint import Checkpointer
+from reference_bank import load_bank
+from scrutinize import (ScrutinizeOptions, ScrutinizeStats, read_one_frame,
+                        scrutinize_with_images_and_thresholds)
+from utils import ROI_LAYOUT, brightness_lut, full_frame_layout, \
+    roi_ffmpeg_arguments, whose_stream_vote
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,10 +38,54 @@ neuro_thresholds = './neuro.npz'
 evil_thresholds = './evil.npz'
 square_size = 20
 depth = 3
+fps = 30
+# Streamer detection votes over this many frames (the first second)
+vote_frames = int(os.getenv('SCRUTINIZE_VOTE_FRAMES', str(fps)))
+
+# ROI mode makes ffmpeg ship only the cropped grid and the detector
+# squares as rawvideo. Set SCRUTINIZE_ROI=0 to pipe whole PPM frames
+roi_mode = os.getenv('SCRUTINIZE_ROI', '1') != '0'
+layout = ROI_LAYOUT if roi_mode else None
+
+# Adaptive sampling: score every Nth frame while nothing is close to its
+# threshold. 1 scores every frame.
+# Workers: number of scorer processes. 0 scores in this process
+# Prefilter: skip exact SSIM for squares that cannot reach their threshold.
+# Set SCRUTINIZE_PREFILTER=0 to score everything
+# Delta gate: squares whose pixels moved by at most SCRUTINIZE_DELTA_TOLERANCE
+# keep their last score. Set it to -1 to rescore every square
+delta_tolerance = int(os.getenv('SCRUTINIZE_DELTA_TOLERANCE', '0'))
+options = ScrutinizeOptions(
+    fps=fps,
+    sample_every=int(os.getenv('SCRUTINIZE_SAMPLE_EVERY', '1')),
+    sample_margin=float(os.getenv('SCRUTINIZE_SAMPLE_MARGIN', '0.1')),
+    workers=int(os.getenv('SCRUTINIZE_WORKERS', '0')),
+    prefilter=os.getenv('SCRUTINIZE_PREFILTER', '1') != '0',
+    delta_tolerance=delta_tolerance if delta_tolerance >= 0 else None)
+stats = ScrutinizeStats()
+
+# Checkpoint: the results so far are rewritten to this file every
+# SCRUTINIZE_CHECKPOINT_INTERVAL seconds, and a leftover checkpoint of an
+# interrupted run is resumed from. Set SCRUTINIZE_RESUME=0 to start over
+checkpoint_path = os.getenv('SCRUTINIZE_CHECKPOINT',
+                            'scrutinize_checkpoint.json')
+checkpoint_interval = float(os.getenv('SCRUTINIZE_CHECKPOINT_INTERVAL', '30'))
+checkpoint_resume = os.getenv('SCRUTINIZE_RESUME', '1') != '0'
+# Only a checkpoint of the same stream is resumed
+checkpoint_stream = os.getenv('SCRUTINIZE_STREAM_ID') or None
+
+# Instrumentation: set SCRUTINIZE_TIMINGS to a path to time every stage of
+# every frame and write a summary there at the end
+timings_path = os.getenv('SCRUTINIZE_TIMINGS')
+options.instrument = bool(timings_path)
 
 # NOTE: FPS is forcefully tuned down to 30. Not sure if this affects accuracy,
 # but it improves inference performance
-command = ('ffmpeg -i - -vf "scale=1280:720,fps=30" -c:v ppm -f image2pipe -')
+if roi_mode:
+    command = f'ffmpeg -i - {roi_ffmpeg_arguments(fps)}'
+else:
+    command = (f'ffmpeg -i - -vf "scale=1280:720,fps={fps}"'
+               ' -c:v ppm -f image2pipe -')
 
 detected_streamers = None
 
@@ -47,17 +94,31 @@ if __name__ != '__main__':
 
 scrutinize_results = []
 
-process = subprocess.Popen(command, shell=True, stdin=sys.stdin,
+# Turn SIGTERM (runner cancelled, timeout) into SystemExit, so scrutinize
+# writes a last checkpoint on its way out
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+process = subprocess.Popen(shlex.split(command), stdin=sys.stdin,
                            stdout=subprocess.PIPE)
 
-first_frame = read_one_frame(process)[0]
+# The frames of the vote are scored too, before the rest of the stream
+first_frames = [read_one_frame(process, layout)[0]]
+while len(first_frames) < vote_frames:
+    try:
+        first_frames.append(read_one_frame(process, layout)[0])
+    except StopIteration:
+        break
+first_frame_layout = layout or full_frame_layout(first_frames[0].shape[1],
+                                                 first_frames[0].shape[0],
+                                                 square_size)
 
 if detected_streamers is None:
-    detected_streamers = [whose_stream(first_frame,
-                                       tutel_detector,
-                                       neuro_detector,
-                                       evil_detector,
-                                       square_size)]
+    detected_streamers = [whose_stream_vote(first_frames,
+                                            tutel_detector,
+                                            neuro_detector,
+                                            evil_detector,
+                                            square_size,
+                                            first_frame_layout)]
 
 logger.info('Detected streamer: %s', detected_streamers[0])
 
@@ -76,7 +137,7 @@ if detected_streamers[0][0] == 'dunno':
 images_array = []
 thresholds_array = []
 detector_squares = []
-adjustment_value = 1.0
+adjustment_values = []
 
 for (detected_streamer, adj_value) in detected_streamers:
     threshold_file = (neuro_thresholds if detected_streamer == 'neuro'
@@ -84,24 +145,36 @@ for (detected_streamer, adj_value) in detected_streamers:
     images_folder = (neuro_folder if detected_streamer == 'neuro'
                      else evil_folder)
     logging.info('Now processing for %s', detected_streamer)
-    images = load_images_from_directory(images_folder)
-    thresholds = load_thresholds(threshold_file)
-    detector_square = extract_dynamic_detector_square(first_frame,
-                                                      square_size)
-
-    if len(images) != len(thresholds):
-        logger.fatal('Mismatch between images and thresholds')
+    try:
+        bank = load_bank(images_folder, threshold_file)
+    except ValueError:
+        logger.fatal('Mismatch between images and thresholds', exc_info=True)
         sys.exit(1)
 
-    images_array.append(images)
-    thresholds_array.append(thresholds)
+    # scrutinize compares brightness-adjusted squares, so the detector square
+    # is taken from the latest frame, adjusted by the gain of this bank
+    detector_square = brightness_lut(adj_value)[
+        first_frame_layout.dynamic_detector_square(first_frames[-1],
+                                                   square_size)]
+
+    images_array.append(bank)
+    thresholds_array.append(bank.thresholds)
     detector_squares.append(detector_square)
-    adjustment_value = max(adjustment_value, adj_value)
+    adjustment_values.append(adj_value)
 
 
+checkpoint = Checkpointer(checkpoint_path,
+                          [streamer for streamer, _ in detected_streamers],
+                          checkpoint_interval, checkpoint_resume,
+                          stream=checkpoint_stream)
 results = scrutinize_with_images_and_thresholds(
     process, images_array, thresholds_array, detector_squares,
-    adjustment_value)
+    adjustment_values, layout, options, stats, checkpoint, first_frames)
+logger.info('Scrutinize stats: %s', stats.summary())
+if timings_path and stats.timers is not None:
+    stats.timers.dump(timings_path, {'stats': stats.summary(),
+                                     'streamers': detected_streamers})
+    logger.info('Wrote stage timings to %s', timings_path)
 
 for idx, detected_streamer in enumerate(detected_streamers):
     res = json.dumps(results[idx])
@@ -112,6 +185,7 @@ for idx, detected_streamer in enumerate(detected_streamers):
 logger.info('Sending this json to stdout: %s', json.dumps(scrutinize_results))
 print(json.dumps(scrutinize_results))
 
-for proc in psutil.process_iter():
-    if proc.name() == 'ffmpeg':
-        proc.kill()
+# scrutinize returns early once everything is found, so ffmpeg may still be
+# running. It is our own child (no shell in between), so stop just that one
+process.kill()
+process.wait()
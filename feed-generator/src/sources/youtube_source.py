@@ -1,50 +1,71 @@
 """
 Represents a YouTube source. When the function is invoked, it hashes
 the lowest quality video stream.
+
+The video is never held in memory: yt-dlp runs in its own process and
+writes it to a pipe, and the hash is updated chunk by chunk as the bytes
+arrive. yt-dlp may download several fragments at once, but it still
+writes them in order, so the hash is the same as the one of the file.
 """
 
 import hashlib
 import logging
-from io import BytesIO
+import subprocess
+import sys
+import time
 from typing import Optional
 
 from utils import check_proxy_variables
-from contextlib import redirect_stdout
-from yt_dlp import YoutubeDL
+
+CHUNK_SIZE = 1 << 16
+# Fragments of DASH/HLS formats downloaded at the same time
+CONCURRENT_FRAGMENTS = 4
 
 
 class YoutubeSource:
     """
     Represents a YouTube source.
     """
-    def __init__(self, url: str) -> None:
+    def __init__(self, url: str,
+                 concurrent_fragments: int = CONCURRENT_FRAGMENTS) -> None:
         self.url = url
         self.hash: Optional[str] = None
-        self.options = {
-            'proxy': check_proxy_variables()
-        }
+        self.concurrent_fragments = concurrent_fragments
+        self.proxy = check_proxy_variables()
 
-    @staticmethod
-    def __calculate_hash(stream: BytesIO) -> str:
-        sha = hashlib.sha256()
-        for chunk in iter(lambda: stream.read(4096), b''):
-            sha.update(chunk)
-        return sha.hexdigest()
+    def __command(self) -> list[str]:
+        command = [sys.executable, '-m', 'yt_dlp',
+                   '--quiet', '--no-progress',
+                   '--format', 'worst',
+                   '--concurrent-fragments', str(self.concurrent_fragments),
+                   '--output', '-']
+        if self.proxy:
+            command += ['--proxy', self.proxy]
+        return command + ['--', self.url]
 
-    @staticmethod
-    def __get_lowest_video_data(video_id: str, options: dict) -> BytesIO:
-        buffer = BytesIO()
-        ctx = {
-            'outtmpl': "-",
-            'logtostderr': True,
-            'format': 'worst',
-            **options
-        }
-        with redirect_stdout(buffer), YoutubeDL(ctx) as ytdl:  # type: ignore
-            ytdl.download([video_id])
+    def __hash_lowest_video(self) -> tuple[str, int]:
+        """
+        Streams the lowest quality video through sha256.
 
-        buffer.seek(0)
-        return buffer
+        Returns:
+            tuple[str, int]: The hash and the size of the video
+
+        Throws:
+            subprocess.CalledProcessError: If yt-dlp failed
+        """
+        sha = hashlib.sha256()
+        size = 0
+        command = self.__command()
+        # yt-dlp logs to stderr when writing the video to stdout
+        with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+            stdout = process.stdout
+            assert stdout is not None
+            for chunk in iter(lambda: stdout.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+                size += len(chunk)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return sha.hexdigest(), size
 
     def get(self) -> Optional[str]:
         """
@@ -56,8 +77,12 @@ class YoutubeSource:
         try:
             logging.info("Retrieving lowest quality resolution for %s",
                          self.url)
-            stream = self.__get_lowest_video_data(self.url, self.options)
-            self.hash = self.__calculate_hash(stream)
+            start = time.perf_counter()
+            self.hash, size = self.__hash_lowest_video()
+            elapsed = time.perf_counter() - start
+            logging.info("Hashed %d bytes of %s in %.1f s (%.0f KB/s)",
+                         size, self.url, elapsed,
+                         size / 1024 / max(elapsed, 1e-6))
             return self.hash
         except:  # pylint: disable=bare-except # noqa: E722
             logging.exception("Could not get video for %s", self.url)
@@ -5,9 +5,103 @@ Utility functions for the application
 import hashlib
 import logging
 import os
-from typing import Optional
+import threading
+from typing import Any, Iterable, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
+
+from blob_store import BLOB_DIRECTORY, BlobStore
+from http_cache import HttpCache
+
+# (connect, read) timeouts of every request, in seconds
+HTTP_TIMEOUT = (10, 60)
+# Connections kept alive per host. At least as many as the threads of
+# the collector in main.py, so none of them waits for a connection
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = Retry(total=2, backoff_factor=1,
+                     status_forcelist=(502, 503, 504))
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_http_cache: Optional[HttpCache] = None
+_blob_store: Optional[BlobStore] = None
+_blob_store_lock = threading.Lock()
+
+
+def http_session() -> requests.Session:
+    """
+    Gets the session shared by every HTTP request: it pools and keeps
+    alive connections per host, negotiates compression (brotli too,
+    when installed) and goes through the proxy, like yt-dlp does.
+    """
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                  pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=HTTP_RETRIES)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(make_headers(accept_encoding=True))
+            proxy = check_proxy_variables()
+            if proxy:
+                session.proxies.update({'http': proxy, 'https': proxy})
+            _session = session
+        return _session
+
+
+def http_get(url: str, **kwargs: Any) -> requests.Response:
+    """
+    GETs the URL with the shared session
+    """
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return http_session().get(url, **kwargs)
+
+
+def use_http_cache(path: str) -> HttpCache:
+    """
+    Makes conditional_get use (and update) the HTTP cache in a file.
+    Call its save() at the end of the run.
+    """
+    global _http_cache  # pylint: disable=global-statement
+    _http_cache = HttpCache(path)
+    return _http_cache
+
+
+def conditional_get(url: str,
+                    keep_body: bool = False) -> tuple[Optional[bytes], str]:
+    """
+    Downloads the URL, unless the HTTP cache knows it did not change,
+    and hashes it.
+
+    Args:
+        url (str): The URL
+        keep_body (bool): Whether the content is needed, even when it
+                          did not change
+
+    Returns:
+        tuple[Optional[bytes], str]: The content (None if it did not
+                                     change and keep_body is False),
+                                     and its sha256
+
+    Throws:
+        requests.HTTPError: If the server answers with an error
+    """
+    cache = _http_cache
+    headers = cache.validators(url, keep_body) if cache is not None else {}
+    logging.info('Downloading %s%s', url, ' (conditional)' if headers else '')
+    response = http_get(url, headers=headers)
+    if response.status_code == 304 and cache is not None:
+        return cache.not_modified(url)
+    response.raise_for_status()
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    if cache is not None:
+        cache.modified(url, response, digest, keep_body)
+    return response.content, digest
 
 
 def download(url: str) -> bytes:
@@ -15,7 +109,7 @@ def download(url: str) -> bytes:
     Downloads the URL and get bytes
     """
     logging.info('Downloading %s', url)
-    response = requests.get(url, timeout=60)
+    response = http_get(url)
     if response.status_code != 200:
         raise RuntimeError(f"Could not download {url}")
     return response.content
@@ -25,10 +119,41 @@ def download_encode_and_hash(url: str) -> str:
     """
     Downloads whatever URL is being pointed to, and hashes it
     """
-    data = download(url)
-    sha = hashlib.sha256()
-    sha.update(data)
-    return sha.hexdigest()
+    return conditional_get(url)[1]
+
+
+def use_blob_store(published: Iterable[str]) -> BlobStore:
+    """
+    Makes fetch_blob use a blob store (blobs/) that knows which blobs
+    are published already.
+
+    Args:
+        published (Iterable[str]): The references of the published
+                                   blobs, e.g. of the previous state
+
+    Returns:
+        BlobStore: The store
+    """
+    global _blob_store  # pylint: disable=global-statement
+    with _blob_store_lock:
+        _blob_store = BlobStore(BLOB_DIRECTORY, conditional_get, published)
+        return _blob_store
+
+
+def fetch_blob(url: str) -> tuple[str, str]:
+    """
+    Downloads whatever URL is being pointed to into the blob store
+    (blobs/), once per run, and only if it changed
+
+    Returns:
+        tuple[str, str]: The sha256 of the content, and the reference
+                         of its blob
+    """
+    global _blob_store  # pylint: disable=global-statement
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore(BLOB_DIRECTORY, conditional_get)
+    return _blob_store.fetch(url)
 
 
 def check_proxy_variables() -> Optional[str]:
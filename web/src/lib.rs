@@ -5,7 +5,7 @@ mod utils;
 use fetcher::*;
 use serde::Serialize;
 use serde_json::from_str;
-use states::{get_match_tuples, ArgState};
+use states::{get_match_tuples, match_thumbnails_by_hash, ArgState};
 use std::collections::HashMap;
 use utils::*;
 use wasm_bindgen::prelude::*;
@@ -76,10 +76,13 @@ pub async fn compare_cache_on_dates(
         }), commit)
     };
 
+    let mut match_tuples = get_match_tuples(&state_lhs, &state_rhs);
+    match_thumbnails_by_hash(&state_lhs, &state_rhs, &mut match_tuples);
+
     serde_wasm_bindgen::to_value(&NeatlyPackedRetVal {
         lhs_state: &state_lhs,
         rhs_state: &state_rhs,
-        match_tuples: get_match_tuples(&state_lhs, &state_rhs),
+        match_tuples,
         lhs_commit: &lhs_commit,
         rhs_commit: &rhs_commit,
     })
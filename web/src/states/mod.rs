@@ -86,3 +86,29 @@ structure_reflection! {
         youtube_channel_info: Option<YouTubeChannel>
     }
 }
+
+/// Thumbnails are compared by the hash in the information of their
+/// video: older states inline them as data URLs, newer ones reference
+/// a blob, so the same image does not always have the same value.
+pub fn match_thumbnails_by_hash(
+    lhs: &ArgState, rhs: &ArgState, match_tuples: &mut HashMap<String, bool>
+) {
+    let (lhs, rhs) = match (serde_json::to_value(lhs), serde_json::to_value(rhs)) {
+        (Ok(lhs), Ok(rhs)) => (lhs, rhs),
+        _ => return,
+    };
+
+    for (key, matches) in match_tuples.iter_mut() {
+        let info = match key.strip_suffix("_thumbnail") {
+            Some(prefix) => format!("{}_info", prefix),
+            None => continue,
+        };
+        let lhs_hash = lhs.get(&info).and_then(|info| info.get("thumbnail"));
+        let rhs_hash = rhs.get(&info).and_then(|info| info.get("thumbnail"));
+        if let (Some(lhs_hash), Some(rhs_hash)) = (lhs_hash, rhs_hash) {
+            if !lhs_hash.is_null() && !rhs_hash.is_null() {
+                *matches = lhs_hash == rhs_hash;
+            }
+        }
+    }
+}
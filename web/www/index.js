@@ -26,6 +26,16 @@ const tableHeaders = "<table id=\"resource-table\"><tr><th>Resource</th><th>Stat
 const tableFooter = "</table>";
 
 const commitURL = "https://github.com/neuro-arg/arg-monitoring/commit/";
+const rawURL = "https://raw.githubusercontent.com/neuro-arg/arg-monitoring/";
+
+// thumbnails are blob references (blobs/<sha256>.jpg) published along
+// with the state. Older states inline them as data URLs instead
+const thumbnailURL = (thumbnail, commit) => {
+  if (!thumbnail || thumbnail.startsWith('data:')) {
+    return thumbnail;
+  }
+  return rawURL + commit + '/' + thumbnail;
+}
 
 // functions and stuff
 const updateTable = async () => {
@@ -54,8 +64,8 @@ const updateTable = async () => {
       const templateStr = `<tr>
                          <td>${key}</td>
                          <td>${statusMapping.get(key) ? "Matches" : "Does not match"}</td>
-                         <td><img src="${lhsState[key]}" style="width: 18em"></img></td>
-                         <td><img src="${rhsState[key]}" style="width: 18em"></img></td>
+                         <td><img src="${thumbnailURL(lhsState[key], lhsCommit)}" loading="lazy" style="width: 18em"></img></td>
+                         <td><img src="${thumbnailURL(rhsState[key], rhsCommit)}" loading="lazy" style="width: 18em"></img></td>
                          </tr>`;
       newInnerHTML += templateStr;
       continue;